@@ -1,8 +1,7 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
 from simdial.domain import Domain, DomainSpec
-from simdial.generator import Generator
-from simdial import complexity
+from simdial.scheduler import run_manifest
 import string
 
 
@@ -298,45 +297,18 @@ if __name__ == "__main__":
 
     test_size = 500
     train_size = 2000
-    gen_bot = Generator()
-
-    rest_spec = RestSpec()
-    rest_style_spec = RestStyleSpec()
-    rest_pitt_spec = RestPittSpec()
-    bus_spec = BusSpec()
-    movie_spec = MovieSpec()
-    weather_spec = WeatherSpec()
-
-    # restaurant
-    gen_bot.gen_corpus("test", rest_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", rest_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", rest_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", rest_spec, complexity.MixSpec, train_size)
-
-    # restaurant style
-    gen_bot.gen_corpus("test", rest_style_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", rest_style_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", rest_style_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", rest_style_spec, complexity.MixSpec, train_size)
-
-    # bus
-    gen_bot.gen_corpus("test", bus_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", bus_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", bus_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", bus_spec, complexity.MixSpec, train_size)
-
-    # weather
-    gen_bot.gen_corpus("test", weather_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", weather_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", weather_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", weather_spec, complexity.MixSpec, train_size)
-
-    # movie
-    gen_bot.gen_corpus("test", movie_spec, complexity.CleanSpec, test_size)
-    gen_bot.gen_corpus("test", movie_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", movie_spec, complexity.CleanSpec, train_size)
-    gen_bot.gen_corpus("train", movie_spec, complexity.MixSpec, train_size)
-
-    # restaurant Pitt
-    gen_bot.gen_corpus("test", rest_pitt_spec, complexity.MixSpec, test_size)
-    gen_bot.gen_corpus("train", rest_pitt_spec, complexity.MixSpec, train_size)
+    splits = {"test": test_size, "train": train_size}
+
+    manifest = {"language": "en",
+                "jobs": [{"domains": ["multiple_domains.RestSpec",
+                                      "multiple_domains.RestStyleSpec",
+                                      "multiple_domains.BusSpec",
+                                      "multiple_domains.WeatherSpec",
+                                      "multiple_domains.MovieSpec"],
+                          "complexities": ["CleanSpec", "MixSpec"],
+                          "splits": splits},
+                         # restaurant Pitt
+                         {"domains": ["multiple_domains.RestPittSpec"],
+                          "complexities": ["MixSpec"],
+                          "splits": splits}]}
+    run_manifest(manifest)
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
 
+from simdial.config import Config
+from collections import deque
 import logging
-import copy
 
 
 class Agent(object):
@@ -25,27 +26,113 @@ class Agent(object):
         raise NotImplementedError("Implement step function is required")
 
 
-class Action(dict):
+class Action(object):
     """
-    A generic class that corresponds to a discourse unit. An action is made of an Act and a list of parameters.
+    A generic class that corresponds to a discourse unit. An action is made of an Act and a tuple of parameters.
     Action 的基类 描述agent的最小动作单元 持有act 类型 和act 参数列表[(slot_name=slot_val),]
-    :ivar act: dialog act String
-    :ivar parameters: [{slot -> usr_constrain}, {sys_slot -> value}] for INFORM, and [(type, value)...] for other acts.
 
+    Actions are immutable. The with_* methods return a modified copy, so an action can be shared by the agents,
+    the channels and the dialog histories without copying it. The containers inside the parameters must not be
+    changed either.
+
+    :ivar act: dialog act String
+    :ivar code: the integer code of act
+    :ivar parameters: ({slot -> usr_constrain}, {sys_slot -> value}) for INFORM, and ((type, value)...) for other acts.
+    :cvar ACTS: code -> act
+    :cvar CODES: act -> code
     """
+    __slots__ = ('code', 'parameters')
+    ACTS = []
+    CODES = {}
 
     def __init__(self, act, parameters=None):
-        self.act = act
         if parameters is None:
-            self.parameters = []
-        elif type(parameters) is not list:
-            self.parameters = [parameters]
+            parameters = ()
+        elif type(parameters) is list:
+            parameters = tuple(parameters)
         else:
-            self.parameters = parameters
-        super(Action, self).__init__(act=self.act, parameters=self.parameters)
+            parameters = (parameters,)
+        object.__setattr__(self, 'code', self.register_act(act))
+        object.__setattr__(self, 'parameters', parameters)
+
+    @classmethod
+    def register_act(cls, act):
+        """
+        :return: the integer code of act. A new code is given to an act seen for the first time.
+        """
+        code = cls.CODES.get(act)
+        if code is None:
+            code = len(cls.ACTS)
+            cls.ACTS.append(act)
+            cls.CODES[act] = code
+        return code
+
+    @property
+    def act(self):
+        return self.ACTS[self.code]
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Action is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Action is immutable")
+
+    def __reduce__(self):
+        # pickle the act by name, the codes may differ between processes
+        return Action, (self.act, list(self.parameters))
+
+    def __eq__(self, other):
+        return isinstance(other, Action) and self.code == other.code and self.parameters == other.parameters
+
+    def __ne__(self, other):
+        return not self == other
 
-    def add_parameter(self, type, value):
-        self.parameters.append((type, value))
+    __hash__ = None
+
+    def __repr__(self):
+        return "Action(%r, %r)" % (self.act, list(self.parameters))
+
+    def with_act(self, act):
+        """
+        :return: a copy with another act
+        """
+        return Action(act, list(self.parameters))
+
+    def with_parameters(self, parameters):
+        """
+        :param parameters: a list of parameters
+        :return: a copy with other parameters
+        """
+        return Action(self.act, list(parameters))
+
+    def with_parameter(self, idx, value):
+        """
+        :return: a copy with parameter idx replaced by value
+        """
+        parameters = list(self.parameters)
+        parameters[idx] = value
+        return Action(self.act, parameters)
+
+    def with_added_parameter(self, type, value):
+        """
+        :return: a copy with (type, value) appended to the parameters
+        """
+        return Action(self.act, list(self.parameters) + [(type, value)])
+
+    def to_dict(self):
+        """
+        :return: the JSON form {act, parameters}
+        """
+        return {'act': self.act, 'parameters': list(self.parameters)}
+
+    @staticmethod
+    def json_default(obj):
+        """
+        The default hook of json.dump for dialogs that contain actions.
+        """
+        if isinstance(obj, Action):
+            return obj.to_dict()
+        raise TypeError("%r is not JSON serializable" % obj)
 
     def dump_string(self):
         str_paras = []
@@ -58,12 +145,51 @@ class Action(dict):
         return "%s:%s" % (self.act, str_paras)
 
 
+class DialogHistory(object):
+    """
+    The turns of a dialog. The last turn of each speaker is always kept, older turns only within the window.
+    对话历史，每个说话人的最近一轮总是保留
+
+    :ivar num_turns: the number of turns so far
+    :ivar last_turns: speaker -> the actions of the last turn of this speaker
+    :ivar turns: the most recent (speaker, actions) turns, at most window of them
+    """
+
+    def __init__(self, window=None):
+        """
+        :param window: the max number of turns to keep in turns. If None, it is Config.history_window, or no limit
+        in debug mode.
+        """
+        if window is None:
+            window = None if Config.debug else Config.history_window
+        self.num_turns = 0
+        self.last_turns = {}
+        self.turns = deque(maxlen=window)
+
+    def append(self, speaker, actions):
+        self.num_turns += 1
+        self.last_turns[speaker] = actions
+        self.turns.append((speaker, actions))
+
+    def last(self, speaker):
+        """
+        :return: the last turn of speaker, None if not found
+        """
+        return self.last_turns.get(speaker)
+
+    def __len__(self):
+        return self.num_turns
+
+    def __iter__(self):
+        return iter(self.turns)
+
+
 class State(object):
     """
     The base class for a dialog state
     状态管理器的基类
 
-    :ivar history: a list of turns
+    :ivar history: a DialogHistory
     :cvar USR: user name
     :cvar SYS: system name
     :cvar LISTEN: the agent is waiting for other's input
@@ -81,7 +207,7 @@ class State(object):
     EXIT = "exit"
 
     def __init__(self):
-        self.history = []
+        self.history = DialogHistory()
 
     def yield_floor(self, *args, **kwargs):
         """
@@ -105,10 +231,7 @@ class State(object):
         :param target_speaker: the target speaker
         :return: the last turn produced by the given speaker. None if not found.
         """
-        for spk, utt in self.history[::-1]:
-            if spk == target_speaker:
-                return utt
-        return None
+        return self.history.last(target_speaker)
 
     def update_history(self, speaker, actions):
         """
@@ -118,8 +241,8 @@ class State(object):
         :param speaker: SYS or USR
         :param actions: a list of Action
         """
-        # make a deep copy of actions
-        self.history.append((speaker, copy.deepcopy(actions)))
+        # actions are immutable, so the turn is kept as it is
+        self.history.append(speaker, actions)
 
 
 class SystemAct(object):
@@ -175,6 +298,13 @@ class UserAct(object):
     KB_RETURN = "kb_return"
 
 
+# give the known acts the first codes, in a fixed order
+for _acts in [SystemAct, UserAct]:
+    for _name in sorted(vars(_acts)):
+        if _name.isupper():
+            Action.register_act(getattr(_acts, _name))
+
+
 class BaseSysSlot(object):
     """
     基础系统类型slot
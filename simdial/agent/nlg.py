@@ -6,7 +6,6 @@ import numpy as np
 from simdial.agent.core import SystemAct, UserAct, BaseUsrSlot
 from simdial.agent import core
 import json
-import copy
 
 
 class AbstractNlg(object):
@@ -14,9 +13,13 @@ class AbstractNlg(object):
     Abstract class of NLG
     """
 
-    def __init__(self, domain, complexity):
+    def __init__(self, domain, complexity, rng=np.random):
+        """
+        :param rng: a numpy RandomState for sampling templates. The global RNG by default.
+        """
         self.domain = domain
         self.complexity = complexity
+        self.rng = rng
 
     def generate_sent(self, actions, **kwargs):
         """
@@ -28,7 +31,7 @@ class AbstractNlg(object):
         raise NotImplementedError("Generate sent is required for NLG")
 
     def sample(self, examples):
-        return np.random.choice(examples)
+        return self.rng.choice(examples)
 
 
 class SysCommonNlg(object):
@@ -53,19 +56,18 @@ class SysNlg(AbstractNlg):
     NLG class to generate utterances for the system side.
     """
 
-    def generate_sent(self, actions, domain=None, templates=SysCommonNlg.templates):
+    def generate_sent(self, actions, domain=None, templates=SysCommonNlg.templates, lexicalize=True):
         """
          Map a list of system actions to a string.
          将一个 system action 列表映射成 string
 
         :param actions: a list of actions        系统动作列表
         :param templates: a common NLG template that uses the default one if not given     # NLG 模板
-        :return: uttearnces in string            # 返回 系统语句
+        :param lexicalize: also return the lexicalized actions, see lexicalize
+        :return: uttearnces in string, the lexicalized actions or None            # 返回 系统语句
         """
         str_actions = []
-        lexicalized_actions = []
         for a in actions:
-            a_copy = copy.deepcopy(a)
             if a.act == SystemAct.GREET:
                 if domain:
                     str_actions.append(domain.greet)   # 输出当前系统的 问候语句
@@ -85,8 +87,6 @@ class SysNlg(AbstractNlg):
                     else:
                         search_dict[k] = slot.vocabulary[v] # value是一个值的数值索引，重slot的词表中取出对应的真实值
 
-                a_copy.parameters[0] = search_dict
-                a_copy.parameters[1] = sys_goals
                 # 这时以json的格式返回 查询语句，和查询目标
                 str_actions.append(json.dumps({"QUERY": search_dict,
                                                "GOALS": sys_goals}))
@@ -96,10 +96,8 @@ class SysNlg(AbstractNlg):
 
                 # create string list for RET + Informs
                 informs = []
-                sys_goal_dict = {}
                 for k, (v, e_v) in sys_goals.items():      # 取出 槽位名称 槽位 追踪值索引 期望值索引
                     slot = self.domain.get_sys_slot(k)     # 取出槽位对应的 对象
-                    sys_goal_dict[k] = slot.vocabulary[v]  # 取出 值索引对应的真实值
 
                     #如果 期望值和追踪值相同， 那么是 user say 前缀添加 yes
                     if e_v is not None:
@@ -107,10 +105,8 @@ class SysNlg(AbstractNlg):
                     else:
                         prefix = ""
                     # 前缀 + slot 采样的模板 + slot 真实值
-                    informs.append(prefix + slot.sample_inform()
+                    informs.append(prefix + slot.sample_inform(self.rng)
                                    % slot.vocabulary[v])
-                # 包村sys——gaol dict
-                a_copy['parameters'] = [sys_goal_dict]
                 # 拼接 inform 列表
                 str_actions.append(" ".join(informs))
 
@@ -122,30 +118,26 @@ class SysNlg(AbstractNlg):
                     target_slot = self.domain.get_usr_slot(slot_type)       # 取出对应的 target slot 对象
                     if target_slot is None:
                         raise ValueError("none slot %s" % slot_type)
-                    str_actions.append(target_slot.sample_request())        # 从slot 对象中随机采样出一个erquest
+                    str_actions.append(target_slot.sample_request(self.rng))        # 从slot 对象中随机采样出一个erquest
 
             elif a.act == SystemAct.EXPLICIT_CONFIRM:                   # 如果系统的动作是不确定澄清
                 slot_type, slot_val = a.parameters[0]
                 if slot_val is None:      # 如果 slot val是none ,那么从模板中采样的是 这个槽位是否可以忽略
                     str_actions.append(self.sample(templates[SystemAct.EXPLICIT_CONFIRM+"dont_care"]))
-                    a_copy.parameters[0] = (slot_type, "dont_care")
                 else:
                     # 否则询问用户是不是这个曹值
                     slot = self.domain.get_usr_slot(slot_type)
                     str_actions.append("Do you mean %s?"
                                        % slot.vocabulary[slot_val])
-                    a_copy.parameters[0] = (slot_type, slot.vocabulary[slot_val])
 
             elif a.act == SystemAct.IMPLICIT_CONFIRM:      # 系统是显式澄清
                 slot_type, slot_val = a.parameters[0]
                 if slot_val is None:   # 同上
                     str_actions.append(self.sample(templates[SystemAct.IMPLICIT_CONFIRM+"dont_care"]))
-                    a_copy.parameters[0] = (slot_type, "dont_care")
                 else:    #同上 确定性反问
                     slot = self.domain.get_usr_slot(slot_type)
                     str_actions.append("I believe you said %s."
                                        % slot.vocabulary[slot_val])
-                    a_copy.parameters[0] = (slot_type, slot.vocabulary[slot_val])
 
             elif a.act in templates.keys():    # 否则如果在模板中，就随机选一个回复
                 str_actions.append(self.sample(templates[a.act]))
@@ -153,10 +145,42 @@ class SysNlg(AbstractNlg):
             else:
                 raise ValueError("Unknown dialog act %s" % a.act)
 
-            lexicalized_actions.append(a_copy)     # 用于json 展示
-
+        lexicalized_actions = self.lexicalize(actions) if lexicalize else None     # 用于json 展示
         return " ".join(str_actions), lexicalized_actions
 
+    def lexicalize(self, actions):
+        """
+        Replace the value indexes in the parameters of system actions with the values. No template is sampled, so
+        it does not use the random stream.
+
+        :param actions: a list of actions
+        :return: a list of lexicalized copies of actions
+        """
+        lexicalized_actions = []
+        for a in actions:
+            if a.act == SystemAct.QUERY:
+                usr_constrains, sys_goals = a.parameters[0], a.parameters[1]
+                search_dict = {}
+                for k, v in usr_constrains:
+                    search_dict[k] = 'dont_care' if v is None else self.domain.get_usr_slot(k).vocabulary[v]
+                a = a.with_parameters([search_dict, sys_goals])
+
+            elif a.act == SystemAct.INFORM:
+                sys_goal_dict = {}
+                for k, (v, e_v) in a.parameters[1].items():
+                    sys_goal_dict[k] = self.domain.get_sys_slot(k).vocabulary[v]
+                a = a.with_parameters([sys_goal_dict])
+
+            elif a.act in (SystemAct.EXPLICIT_CONFIRM, SystemAct.IMPLICIT_CONFIRM):
+                slot_type, slot_val = a.parameters[0]
+                if slot_val is None:
+                    a = a.with_parameter(0, (slot_type, "dont_care"))
+                else:
+                    a = a.with_parameter(0, (slot_type, self.domain.get_usr_slot(slot_type).vocabulary[slot_val]))
+
+            lexicalized_actions.append(a)
+        return lexicalized_actions
+
 
 class UserNlg(AbstractNlg):
     """
@@ -189,7 +213,7 @@ class UserNlg(AbstractNlg):
             elif a.act == UserAct.REQUEST:       # 如果是request， 就从 对应的slot中采样出 对应的request 语句
                 slot_type, _ = a.parameters[0]
                 target_slot = self.domain.get_sys_slot(slot_type)
-                str_actions.append(target_slot.sample_request())
+                str_actions.append(target_slot.sample_request(self.rng))
 
             elif a.act == UserAct.INFORM:          # 如果是 inform 动作
                 has_self_correct = a.parameters[-1][0] == BaseUsrSlot.SELF_CORRECT    # 判断是不是自己错误
@@ -200,10 +224,10 @@ class UserNlg(AbstractNlg):
                     if val is None:
                         return self.sample(["Anything is fine.", "I don't care.", "Whatever is good."])
                     else:
-                        return target_slot.sample_inform() % target_slot.vocabulary[val]
+                        return target_slot.sample_inform(self.rng) % target_slot.vocabulary[val]
 
                 if has_self_correct:     # 如果是自己错误
-                    wrong_value = target_slot.sample_different(slot_value)    # 随机采样一个其他的曹值
+                    wrong_value = target_slot.sample_different(slot_value, self.rng)    # 随机采样一个其他的曹值
                     wrong_utt = get_inform_utt(wrong_value)                   # 使用错误值生成inform 语句
                     correct_utt = get_inform_utt(slot_value)                  # 使用正确值生成 inform 语句
                     connector = self.sample(["Oh no,", "Uhm sorry,", "Oh sorry,"])        # 连接语句
@@ -218,7 +242,7 @@ class UserNlg(AbstractNlg):
                 slot_type, expect_id = a.parameters[0]                 # 从参数中取出 slot name 和期望曹值的 id
                 target_slot = self.domain.get_sys_slot(slot_type)      # 取出 系统slot对象
                 expect_val = target_slot.vocabulary[expect_id]         # 取出 期望的val
-                str_actions.append(target_slot.sample_yn_question(expect_val))   # 采样出yes no 问题模板
+                str_actions.append(target_slot.sample_yn_question(expect_val, self.rng))   # 采样出yes no 问题模板
 
             elif a.act == UserAct.CONFIRM:
                 str_actions.append(self.sample(["Yes.", "Yep.", "Yeah.", "That's correct.", "Uh-huh."]))
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+System policies that make the decisions of many dialogs at once, e.g. a learned policy that runs one forward pass
+for a whole batch. See BatchEngine for the driver that gathers the pending decisions.
+"""
+from simdial.agent.core import Action, State, SystemAct, UserAct, BaseUsrSlot
+from simdial.agent.system import BeliefSlot, PolicyTable
+import numpy as np
+
+
+def encode_states(states, belief_buffers=None):
+    """
+    Encode the system dialog states of a batch into arrays.
+
+    :param states: a list of DialogState of the same domain
+    :param belief_buffers: (scores, observed, max_idx) of the beliefs of states, e.g. rows of the arrays of a
+    BatchEngine. Gathered from states if None.
+    :return: a dict of arrays, each with one row per state:
+
+    - belief_scores: the scores of every user slot, see BeliefSlot : float [batch, num_usr_slots, width]
+    - belief_observed: the observed values of every user slot : bool [batch, num_usr_slots, width]
+    - max_idx: the index of the max conf value of every user slot, -1 if none : int [batch, num_usr_slots]
+    - max_conf: the max conf of every user slot, 0.0 if none : float [batch, num_usr_slots]
+    - goal_conf: the conf of every system goal : float [batch, num_sys_goals]
+    - goal_delivered: whether every system goal is delivered : bool [batch, num_sys_goals]
+    - pending_return: whether a KB return is waiting to be informed : bool [batch]
+    - num_turns: the number of turns so far : int [batch]
+    - last_usr_acts: the acts of the last user turn, indexed by Action code : bool [batch, len(Action.ACTS)]
+    - slot_ids: the slot id of every user slot, see Domain.get_slot_id : int [batch, num_usr_slots]
+    - goal_ids: the slot id of every system goal : int [batch, num_sys_goals]
+    """
+    if belief_buffers is None:
+        belief_buffers = [np.stack([getattr(s, name) for s in states])
+                          for name in ['belief_scores', 'belief_observed', 'belief_max_idx']]
+    scores, observed, max_idx = belief_buffers
+    stale = max_idx == BeliefSlot.STALE
+    if stale.any():
+        max_idx = max_idx.copy()
+        max_idx[stale] = BeliefSlot.argmax(scores[stale], observed[stale])
+    batch, num_slots = max_idx.shape
+    max_conf = scores[np.arange(batch)[:, None], np.arange(num_slots)[None, :], np.maximum(max_idx, 0)]
+    max_conf = np.where(max_idx >= 0, max_conf, 0.0)
+
+    num_goals = len(states[0].sys_goals) if states else 0
+    goal_conf = np.zeros((batch, num_goals))
+    goal_delivered = np.zeros((batch, num_goals), dtype=bool)
+    last_usr_acts = np.zeros((batch, len(Action.ACTS)), dtype=bool)
+    for i, s in enumerate(states):
+        for j, goal in enumerate(s.sys_goals.values()):
+            goal_conf[i, j] = goal.conf
+            goal_delivered[i, j] = goal.delivered
+        for a in s.last_actions(State.USR) or []:
+            last_usr_acts[i, a.code] = True
+    domain = states[0].domain if states else None
+    slot_ids = [domain.get_slot_id(name) for name in states[0].usr_beliefs] if states else []
+    goal_ids = [domain.get_slot_id(name) for name in states[0].sys_goals] if states else []
+
+    return {'belief_scores': scores, 'belief_observed': observed, 'max_idx': max_idx, 'max_conf': max_conf,
+            'goal_conf': goal_conf, 'goal_delivered': goal_delivered,
+            'pending_return': np.array([s.has_pending_return() for s in states], dtype=bool),
+            'num_turns': np.array([len(s.history) for s in states], dtype=np.int64),
+            'last_usr_acts': last_usr_acts,
+            'slot_ids': np.tile(np.array(slot_ids, dtype=np.int64), (batch, 1)),
+            'goal_ids': np.tile(np.array(goal_ids, dtype=np.int64), (batch, 1))}
+
+
+class BatchPolicy(object):
+    """
+    A system policy that decides for a batch of dialogs. A decision is what System.policy returns: the next
+    actions of the system turn. The turn goes on until its last action is a REQUEST, an EXPLICIT_CONFIRM or a QUERY,
+    or a GOODBYE ends the dialog, so a policy is asked again for the dialogs whose turn did not end.
+    """
+
+    def act(self, states, features):
+        """
+        :param states: the DialogState of every dialog with a pending decision
+        :param features: the states encoded by encode_states
+        :return: one decision per state, each an Action, a list of Action or None
+        """
+        raise NotImplementedError("act is required for a batch policy")
+
+
+class RulePolicy(BatchPolicy):
+    """
+    The rule based policy of System as a BatchPolicy. It looks the decisions up in the PolicyTable of each state,
+    so it gives the same dialogs as System.
+    """
+
+    def act(self, states, features):
+        return [PolicyTable.for_state(s).decide(s) for s in states]
+
+
+class DiscreteActions(object):
+    """
+    A discrete action space over the decisions of the rule based policy, for agents that output a code per decision.
+    A code is filled into the actions with the current values of the state, the same way as a PolicyTable plan:
+
+    - GREET: greet and ask what the user needs
+    - GOODBYE: end the dialog
+    - INFORM: inform the pending KB return and ask if the user is happy
+    - QUERY: query the KB with the max conf values for the goals the user asked for
+    - REQUEST_NEED: ask what the user needs
+    - SLOT + len(SLOT_ACTS) * i + j: act SLOT_ACTS[j] on the user slot i, i.e. request it, or confirm its max conf
+      value explicitly or implicitly. slot_code and slot_act map these codes to and from (act, slot id).
+
+    Not every code is valid in every state, see mask. After the user says goodbye only GOODBYE is, INFORM needs a
+    KB return with a value for every active goal, QUERY needs an active goal and a DB entry that matches the max
+    conf values, and a confirm needs an observed value.
+
+    :ivar table: the PolicyTable of the states
+    :ivar slot_ids: the slot id of every user slot of table, see Domain.get_slot_id
+    :ivar size: the number of codes
+    """
+    GREET, GOODBYE, INFORM, QUERY, REQUEST_NEED, SLOT = range(6)
+    SLOT_ACTS = [SystemAct.REQUEST, SystemAct.EXPLICIT_CONFIRM, SystemAct.IMPLICIT_CONFIRM]
+
+    def __init__(self, table, slot_ids):
+        self.table = table
+        self.slot_ids = tuple(slot_ids)
+        self.slot_index = {sid: i for i, sid in enumerate(self.slot_ids)}
+        self.size = self.SLOT + len(self.SLOT_ACTS) * len(table.slot_names)
+
+    @classmethod
+    def for_state(cls, state):
+        """
+        :param state: a DialogState
+        :return: the action space of the dialogs with the slots and goals of state
+        """
+        table = PolicyTable.for_state(state)
+        return cls(table, [state.domain.get_slot_id(name) for name in table.slot_names])
+
+    def slot_code(self, act, sid):
+        """
+        :param act: one of SLOT_ACTS
+        :param sid: the slot id of a user slot
+        :return: the code of act on the slot
+        """
+        return self.SLOT + len(self.SLOT_ACTS) * self.slot_index[sid] + self.SLOT_ACTS.index(act)
+
+    def slot_act(self, code):
+        """
+        :param code: an integer in [0, size)
+        :return: (act, slot id) of a slot code, or None for the other codes
+        """
+        if code < self.SLOT:
+            return None
+        i, j = divmod(code - self.SLOT, len(self.SLOT_ACTS))
+        return self.SLOT_ACTS[j], self.slot_ids[i]
+
+    def mask(self, state):
+        """
+        :param state: a DialogState
+        :return: the codes that are valid in state : bool array [size]
+        """
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.GOODBYE] = True
+        if any(a.act == UserAct.GOODBYE for a in state.last_actions(State.USR) or []):
+            return mask
+
+        table = self.table
+        bands, goals, max_idx = table.signature(state)
+        mask[self.GREET] = True
+        mask[self.REQUEST_NEED] = True
+        # a goal that became active after the query has no value to inform yet
+        mask[self.INFORM] = state.has_pending_return() and all(
+            goal.value is not None for goal, g in zip(state.sys_goals.values(), goals) if g == table.ACTIVE)
+        if table.ACTIVE in goals:
+            mask[self.QUERY] = state.domain.db.exists([BeliefSlot.index_value(idx) for idx in max_idx])
+        num_acts = len(self.SLOT_ACTS)
+        for i, idx in enumerate(max_idx):
+            for j, act in enumerate(self.SLOT_ACTS):
+                mask[self.SLOT + num_acts * i + j] = act == SystemAct.REQUEST or idx >= 0
+        return mask
+
+    def masks(self, states):
+        """
+        :param states: a list of DialogState
+        :return: the mask of every state : bool array [len(states), size]
+        """
+        return np.array([self.mask(s) for s in states], dtype=bool).reshape(len(states), self.size)
+
+    def decode(self, code, state):
+        """
+        :param code: an integer in [0, size)
+        :param state: the DialogState to decide for
+        :return: the list of Action of code. ValueError if code is not valid in state, see mask.
+        """
+        if not 0 <= code < self.size:
+            raise ValueError("Unknown action code %s" % code)
+        if not self.mask(state)[code]:
+            raise ValueError("Action code %s is not valid in this state" % code)
+        table = self.table
+        bands, goals, max_idx = table.signature(state)
+        if code == self.GREET:
+            plan = table.plan((table.GREET,))
+        elif code == self.GOODBYE:
+            plan = table.plan((table.GOODBYE,))
+        elif code == self.INFORM:
+            plan = table.plan((table.RETURN, goals))
+        elif code == self.QUERY:
+            active = tuple(name for name, g in zip(table.goal_names, goals) if g == table.ACTIVE)
+            plan = [(SystemAct.QUERY, table.QUERY, active)]
+        elif code == self.REQUEST_NEED:
+            plan = [(SystemAct.REQUEST, table.CONST, (BaseUsrSlot.NEED, None))]
+        else:
+            act, sid = self.slot_act(code)
+            if act == SystemAct.REQUEST:
+                plan = [(SystemAct.REQUEST, table.CONST, (state.domain.get_slot(sid).name, None))]
+            else:
+                plan = [(act, table.CONFIRM, self.slot_index[sid])]
+        return table.fill(plan, state, max_idx)
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
 
-from simdial.agent.core import Agent, Action, State, SystemAct, UserAct, BaseSysSlot, BaseUsrSlot
+from simdial.agent.core import Agent, Action, State, SystemAct, UserAct, BaseSysSlot, BaseUsrSlot, DialogHistory
 import logging
 from collections import OrderedDict
 import numpy as np
+import bisect
 import copy
 
 
@@ -13,7 +14,15 @@ class BeliefSlot(object):
     A slot with a probabilistic distribution over the possible values
     槽位在各个曹值上的概率分布
 
-    :ivar value_map: entity_value -> (score, norm_value)
+    The scores live in an array over the vocabulary, so updates are vectorized and the max is cached. The arrays
+    can be views into a matrix shared by all the slots of a DialogState.
+
+    :ivar scores: the confidence of each value. Index 0 is None (don't care) and index v+1 is value v : float array
+    :ivar observed: True for the values seen so far : bool array
+    :ivar max_idx: the cached index of the highest score, -1 if nothing is observed, STALE if it needs to be
+    computed again : int array [1]
+    :ivar num_observed: the number of values seen so far
+    :cvar STALE: the max_idx of a changed slot
     :ivar last_update_turn: the last turn ID this slot is modified
     :ivar uid: the unique ID, i.e. slot name
     """
@@ -21,74 +30,129 @@ class BeliefSlot(object):
     EXPLICIT_THRESHOLD = 0.2            # 需要显式澄清的阈值
     IMPLICIT_THRESHOLD = 0.6            # 需要隐式澄清的阈值
     GROUND_THRESHOLD = 0.95             # 基础阈值
+    STALE = -2
 
-    def __init__(self, uid, vocabulary):
+    def __init__(self, uid, vocabulary, scores=None, observed=None, max_idx=None):
+        """
+        :param scores: a zero float array [len(vocabulary)+1] to keep the scores in. A new one if None.
+        :param observed: a False bool array [len(vocabulary)+1] to keep the observed mask in. A new one if None.
+        :param max_idx: an int array [1] that holds -1 to keep the cached max index in. A new one if None.
+        """
         self.uid = uid
-        self.value_map = {}             # 槽位值的map key： slot_val   value: prob
+        self.scores = np.zeros(len(vocabulary)+1) if scores is None else scores
+        self.observed = np.zeros(len(vocabulary)+1, dtype=bool) if observed is None else observed
+        self.max_idx = np.full(1, -1, dtype=np.int64) if max_idx is None else max_idx   # 置信最大的曹值的下标缓存
+        self.num_observed = 0
         self.last_update_turn = -1
         self.logger = logging.getLogger(__name__)
 
+    @staticmethod
+    def value_index(value):
+        return 0 if value is None else value + 1
+
+    @staticmethod
+    def index_value(idx):
+        return None if idx == 0 else idx - 1
+
+    @property
+    def value_map(self):
+        """
+        :return: value -> score of the observed values
+        """
+        return {self.index_value(idx): self.scores[idx] for idx in np.flatnonzero(self.observed)}
+
     def add_new_observation(self, value, conf, turn_id):
         # 看到曹值，更新最近一次的修改轮数id
         self.last_update_turn = turn_id
+        idx = self.value_index(value)
 
         # 更新曹值的置信
-        if value in self.value_map.keys():
+        if self.observed[idx]:
             # 如果曹值已经出现过，那么在当前置信和之前置信的最大值上加0.2
-            prev_conf = self.value_map[value]
-            self.value_map[value] = max([prev_conf, conf]) + 0.2
+            self.scores[idx] = max([self.scores[idx], conf]) + 0.2
             self.logger.info("Update %s conf to %f at turn %d" % (value, conf, turn_id))
         else:
             # 如果之前没有出现过，那么将其他出现过的曹值的置信都减少一半，
             # 记录当前曹值的置信
-            self.value_map = {k: c/2 for k, c in self.value_map.items()}
-            self.value_map[value] = conf
+            self.scores[self.observed] /= 2
+            self.scores[idx] = conf
+            self.observed[idx] = True
+            self.num_observed += 1
             self.logger.info("Add %s conf as %f at turn %d" % (value, conf, turn_id))
+        self.max_idx[0] = self.STALE
 
     def add_grounding(self, confirm_conf, disconfirm_conf, turn_id, target_value=None):
         '''
         根据confirm_conf, disconfirm_conf两个值更新基础置信度，
         '''
-        if len(self.value_map) > 0:
+        if self.num_observed > 0:
             self.last_update_turn = turn_id
             # 如果target value为空，那么选取当前最大置信的value作为 grounded_value (就是slot最有可能的值)
             if target_value is None:
                 grounded_value = self.get_maxconf_value()
             else:
                 grounded_value = target_value
+            idx = self.value_index(grounded_value)
+            if not self.observed[idx]:
+                raise KeyError(grounded_value)
 
             # 更新slot 最有可能的值的 conf
             up_conf = confirm_conf * (1.0 - self.EXPLICIT_THRESHOLD)        # 对曹值的确认概率增益
             down_conf = disconfirm_conf * (1.0 - self.EXPLICIT_THRESHOLD)   # 对曹值的不确定概率增益
-            old_conf = self.value_map[grounded_value]
+            old_conf = self.scores[idx]
             new_conf = max(0.0, min((old_conf + up_conf - down_conf), 1.5))   # 旧的置信 + 确认增益 - 不确定增益
-            self.value_map[grounded_value] = new_conf
+            self.scores[idx] = new_conf
+            self.max_idx[0] = self.STALE
             self.logger.info(
                 "Ground %s from %f to %f at turn %d" % (grounded_value, old_conf, new_conf, turn_id))
         else:
             self.logger.warn("Warn an concept without value")
 
+    def _argmax(self):
+        """
+        :return: the index of the highest score, -1 if nothing is observed
+        """
+        idx = int(self.max_idx[0])
+        if idx == self.STALE:
+            idx = int(self.argmax(self.scores, self.observed))
+            self.max_idx[0] = idx
+        return idx
+
+    @staticmethod
+    def argmax(scores, observed):
+        """
+        :param scores: the scores of one or many slots : float array [..., width]
+        :param observed: the observed masks of the same slots : bool array [..., width]
+        :return: the index of the highest observed score of each slot, -1 if nothing is observed : int array [...]
+        """
+        # ties go to the highest index, the same as max() over (score, value) pairs in which None is the lowest
+        masked = np.where(observed, scores, -np.inf)
+        idx = masked.shape[-1] - 1 - np.argmax(masked[..., ::-1], axis=-1)
+        return np.where(observed.any(axis=-1), idx, -1)
+
     def get_maxconf_value(self):
         '''
         获取置信最大的槽位
         '''
-        if len(self.value_map) == 0:
+        idx = self._argmax()
+        if idx < 0:
             return None
-        max_s, max_v = max([(s, v) for v, s in self.value_map.items()])
-        return max_v
+        return self.index_value(idx)
 
     def max_conf(self):
         """
         获取最大的置信度
         :return: the highest confidence of all potential values. 0.0 if its empty
         """
-        if len(self.value_map) == 0:
+        idx = self._argmax()
+        if idx < 0:
             return 0.0
-        return max([s for s in self.value_map.values()])
+        return self.scores[idx]
 
     def clear(self, turn_id):
         middle = (self.IMPLICIT_THRESHOLD+self.EXPLICIT_THRESHOLD)/2.
-        self.value_map = {k: middle for k in self.value_map.keys()}
+        self.scores[self.observed] = middle
+        self.max_idx[0] = self.STALE
 
 
 class BeliefGoal(object):
@@ -129,25 +193,49 @@ class DialogState(State):
     The dialog state class for a system
     dm的状态跟踪类
 
-    :ivar history: the raw dialog history                                            对话历史
+    :ivar history: the raw dialog history : DialogHistory                            对话历史
     :ivar spk_state: the FSM state for turn-taking. SPK, LISTEN or EXIT              agent的状态
-    :ivar valid_entries: a list of valid system entries satisfy the user belief
+    :ivar num_valid_entries: the number of system entries that satisfy the user belief
     :ivar usr_beliefs: a dict of slot name -> BeliefSlot()                           user slot 的置信
+    :ivar belief_scores: the scores of all usr_beliefs, one row per user slot : float array [num_usr_slots, max_dim+1]
+    :ivar belief_observed: the observed masks of all usr_beliefs : bool array [num_usr_slots, max_dim+1]
+    :ivar belief_max_idx: the cached max index of all usr_beliefs : int array [num_usr_slots]
     :ivar sys_goals:  a dict of system goal that is obligated to answer              需要回答的sys goal列表
     """
     INFORM_THRESHOLD = 5
 
-    def __init__(self, domain):
+    def __init__(self, domain, belief_buffers=None):
+        """
+        :param belief_buffers: (scores, observed, max_idx) arrays in the shapes of belief_scores, belief_observed and
+        belief_max_idx, filled with 0, False and -1, to keep the beliefs in. New ones if None.
+        """
         super(State, self).__init__()
-        self.history = []
+        self.history = DialogHistory()
         self.spk_state = self.SPEAK
-        self.usr_beliefs = OrderedDict([(s.name, BeliefSlot(s.name, s.vocabulary)) for s in domain.usr_slots])
+        # the beliefs of all user slots are rows of one matrix
+        if belief_buffers is None:
+            belief_buffers = self.new_belief_buffers(domain)
+        self.belief_scores, self.belief_observed, self.belief_max_idx = belief_buffers
+        self.usr_beliefs = OrderedDict([(s.name, BeliefSlot(s.name, s.vocabulary, self.belief_scores[i, :s.dim+1],
+                                                            self.belief_observed[i, :s.dim+1],
+                                                            self.belief_max_idx[i:i+1]))
+                                        for i, s in enumerate(domain.usr_slots)])
         self.sys_goals = OrderedDict([(s.name, BeliefGoal(s.name)) for s in domain.sys_slots])
         self.sys_goals[BaseSysSlot.DEFAULT] = BeliefGoal(BaseSysSlot.DEFAULT, conf=1.0)
-        self.valid_entries = domain.db.select(self.gen_query())
+        self.num_valid_entries = domain.db.count(self.gen_query())
         self.pending_return = None
         self.domain = domain
 
+    @staticmethod
+    def new_belief_buffers(domain, shape=()):
+        """
+        :param shape: the leading dimensions, e.g. (batch_size,) for the beliefs of many dialogs
+        :return: empty (scores, observed, max_idx) arrays for the user slots of domain
+        """
+        shape = tuple(shape) + (len(domain.usr_slots),)
+        width = max([s.dim for s in domain.usr_slots] + [0]) + 1
+        return np.zeros(shape + (width,)), np.zeros(shape + (width,), dtype=bool), np.full(shape, -1, dtype=np.int64)
+
     def turn_id(self):
         return len(self.history)
 
@@ -172,7 +260,7 @@ class DialogState(State):
         '''
         判断当前是否可以输出信息了
         '''
-        # if len(self.valid_entries) <= self.INFORM_THRESHOLD:
+        # if self.num_valid_entries <= self.INFORM_THRESHOLD:
         #    return True
 
         for slot in self.usr_beliefs.values():
@@ -238,15 +326,195 @@ class DialogState(State):
                 'kb_update': self.has_pending_return()}
 
 
+class PolicyTable(object):
+    """
+    System.policy compiled into a lookup table. The rule based policy only depends on a discretized dialog state: the
+    phase of the dialog, the band of the max confidence of every user slot against EXPLICIT_THRESHOLD,
+    IMPLICIT_THRESHOLD and GROUND_THRESHOLD, and the state of every system goal against BeliefGoal.THRESHOLD. The
+    table maps that signature to a plan, i.e. a list of action templates, which is compiled the first time the
+    signature is seen and filled with the current slot values on every lookup.
+
+    A plan entry is (act, fill, arg):
+
+    - CONST: Action(act, arg)
+    - CONFIRM: Action(act, (slot name, max conf value)) of the user slot at index arg
+    - QUERY: Action(act, [[(slot name, max conf value)], list(arg)]) with the goal names arg
+    - INFORM: Action(act, [dict(pending_return), {goal name: (value, expected value)}]) with the goal names arg
+
+    :ivar slot_names: the names of the user slots, in the order of the beliefs
+    :ivar goal_names: the names of the system goals, in the order of the beliefs
+    :ivar plans: signature -> plan, or None for a signature without a valid action
+    :cvar BANDS: the upper bounds of the belief bands, see BeliefSlot
+    :cvar tables: (slot_names, goal_names) -> PolicyTable, shared by all the systems of a process
+    """
+    BANDS = [BeliefSlot.EXPLICIT_THRESHOLD, BeliefSlot.IMPLICIT_THRESHOLD, BeliefSlot.GROUND_THRESHOLD]
+    REQUESTED, CONFIRMED, IMPLIED, GROUNDED = range(4)      # the band of a user slot
+    IDLE, PENDING, ACTIVE = range(3)                        # the state of a system goal
+    GREET, GOODBYE, RETURN, BELIEF = range(4)               # the phase of the dialog
+    CONST, CONFIRM, QUERY, INFORM = range(4)                # how a template is filled
+    tables = {}
+
+    def __init__(self, slot_names, goal_names):
+        self.slot_names = tuple(slot_names)
+        self.goal_names = tuple(goal_names)
+        self.plans = {}
+
+    @classmethod
+    def for_state(cls, state):
+        """
+        :param state: a DialogState
+        :return: the shared table for the slots and the goals of state
+        """
+        key = (tuple(state.usr_beliefs.keys()), tuple(state.sys_goals.keys()))
+        table = cls.tables.get(key)
+        if table is None:
+            table = cls.tables[key] = cls(*key)
+        return table
+
+    def signature(self, state):
+        """
+        :param state: a DialogState. The phase is not read, see decide.
+        :return: the bands of the user slots, the states of the system goals, the max conf value indexes
+        """
+        # the slots are few, so a loop over the cached max is faster than array operations
+        bands = []
+        max_idx = []
+        for slot in state.usr_beliefs.values():
+            idx = slot._argmax()
+            bands.append(bisect.bisect_right(self.BANDS, slot.scores[idx] if idx >= 0 else 0.0))
+            max_idx.append(idx)
+
+        goals = []
+        for goal in state.sys_goals.values():
+            if BeliefGoal.THRESHOLD > goal.conf > 0:
+                goals.append(self.PENDING)
+            elif goal.delivered is False and goal.conf >= BeliefGoal.THRESHOLD:
+                goals.append(self.ACTIVE)
+            else:
+                goals.append(self.IDLE)
+        return tuple(bands), tuple(goals), max_idx
+
+    def decide(self, state):
+        """
+        The same as System.policy, including the changes to state.
+
+        :param state: a DialogState
+        :return: a list of Action, or None
+        """
+        if state.spk_state == State.EXIT:
+            return None
+        if len(state.history) == 0:
+            return self.fill(self.plan((self.GREET,)), state, None)
+
+        last_usr = state.last_actions(DialogState.USR)
+        if last_usr is None:
+            raise ValueError("System should talk first")
+        for usr_act in last_usr:
+            if usr_act.act == UserAct.GOODBYE:
+                state.spk_state = State.EXIT
+                return self.fill(self.plan((self.GOODBYE,)), state, None)
+
+        bands, goals, max_idx = self.signature(state)
+        if state.has_pending_return():
+            actions = self.fill(self.plan((self.RETURN, goals)), state, max_idx)
+            state.pending_return = None
+            return actions
+        return self.fill(self.plan((self.BELIEF, bands, goals)), state, max_idx)
+
+    def plan(self, key):
+        """
+        :return: the plan of the signature key, compiled if it is new
+        """
+        try:
+            return self.plans[key]
+        except KeyError:
+            plan = self.plans[key] = self.compile(key)
+            return plan
+
+    def compile(self, key):
+        """
+        :param key: a signature, see decide
+        :return: the plan that System.policy follows in every state with the signature
+        """
+        phase = key[0]
+        if phase == self.GREET:
+            return [(SystemAct.GREET, self.CONST, None), (SystemAct.REQUEST, self.CONST, (BaseUsrSlot.NEED, None))]
+        if phase == self.GOODBYE:
+            return [(SystemAct.GOODBYE, self.CONST, None)]
+
+        goals = key[-1]
+        active = tuple(name for name, g in zip(self.goal_names, goals) if g == self.ACTIVE)
+        if phase == self.RETURN:
+            return [(SystemAct.INFORM, self.INFORM, active), (SystemAct.REQUEST, self.CONST, (BaseUsrSlot.HAPPY, None))]
+
+        bands = key[1]
+        if all(b == self.GROUNDED for b in bands) and self.PENDING not in goals:
+            # ready to inform
+            if len(active) == 0:
+                return None
+            return [(SystemAct.QUERY, self.QUERY, active)]
+
+        implicit_confirms = [(SystemAct.IMPLICIT_CONFIRM, self.CONFIRM, i)
+                             for i, b in enumerate(bands) if b == self.IMPLIED]
+        slot_requests = [(SystemAct.REQUEST, self.CONST, (self.slot_names[i], None))
+                         for i, b in enumerate(bands) if b == self.REQUESTED]
+        others = [(SystemAct.EXPLICIT_CONFIRM, self.CONFIRM, i) for i, b in enumerate(bands) if b == self.CONFIRMED]
+        if self.PENDING in goals:
+            others.append((SystemAct.REQUEST, self.CONST, (BaseUsrSlot.NEED, None)))
+        return implicit_confirms + (slot_requests or others)[0:1]
+
+    def fill(self, plan, state, max_idx):
+        """
+        :return: the actions of plan with the current values of state
+        """
+        if plan is None:
+            raise ValueError("Empty goal. Debug!")
+        actions = []
+        for act, fill, arg in plan:
+            if fill == self.CONST:
+                actions.append(Action(act, arg))
+            elif fill == self.CONFIRM:
+                actions.append(Action(act, (self.slot_names[arg], BeliefSlot.index_value(max_idx[arg]))))
+            elif fill == self.QUERY:
+                query = [(name, BeliefSlot.index_value(idx)) for name, idx in zip(self.slot_names, max_idx)]
+                actions.append(Action(act, [query, list(arg)]))
+            elif fill == self.INFORM:
+                goals = {}
+                for name in arg:
+                    goal = state.sys_goals[name]
+                    goals[name] = (goal.value, goal.expected_value)
+                actions.append(Action(act, [dict(state.pending_return), goals]))
+        return actions
+
+
 class System(Agent):
     """
     basic system agent
+
+    :ivar turn_actions: the actions of the current response, see begin_response
+    :ivar turn_state: the state summary of the current response
+    :cvar RULES: the policy mode that evaluates the rules of policy on every call
+    :cvar TABLE: the policy mode that looks the action up in a PolicyTable
+    :cvar VERIFY: the policy mode that does both and raises ValueError if they differ
     """
     logger = logging.getLogger(__name__)
+    RULES = 'rules'
+    TABLE = 'table'
+    VERIFY = 'verify'
 
-    def __init__(self, domain, complexity):
+    def __init__(self, domain, complexity, belief_buffers=None, policy_mode=RULES):
+        """
+        :param belief_buffers: the arrays to keep the beliefs in, see DialogState
+        :param policy_mode: RULES, TABLE or VERIFY. The actions are the same in every mode.
+        """
         super(System, self).__init__(domain, complexity)
-        self.state = DialogState(domain)
+        if policy_mode not in (self.RULES, self.TABLE, self.VERIFY):
+            raise ValueError("Unknown policy mode %s" % policy_mode)
+        self.state = DialogState(domain, belief_buffers)
+        self.policy_mode = policy_mode
+        self.policy_table = None if policy_mode == self.RULES else PolicyTable.for_state(self.state)
+        self.turn_actions = []
+        self.turn_state = None
 
     def state_update(self, usr_actions, conf):
         """
@@ -318,6 +586,24 @@ class System(Agent):
                 self.state.usr_beliefs[slot].add_grounding(1.0, 0.0, self.state.turn_id())
 
     def policy(self):
+        if self.policy_mode == self.TABLE:
+            return self.policy_table.decide(self.state)
+        if self.policy_mode == self.RULES:
+            return self.rule_policy()
+
+        # verify: the table and the rules must give the same actions and make the same changes to the state
+        before = self.state.spk_state, self.state.pending_return
+        compiled = self.policy_table.decide(self.state)
+        after = self.state.spk_state, self.state.pending_return
+        self.state.spk_state, self.state.pending_return = before
+        actions = self.rule_policy()
+        expected = [actions] if isinstance(actions, Action) else actions
+        if compiled != expected or after != (self.state.spk_state, self.state.pending_return):
+            raise ValueError("Policy table gives %s instead of %s at turn %d"
+                             % (compiled, expected, self.state.turn_id()))
+        return actions
+
+    def rule_policy(self):
         if self.state.spk_state == State.EXIT:
             return None
 
@@ -405,25 +691,66 @@ class System(Agent):
         :param conf: the probability that this user input is correct
         :return: reward, terminal, [Action], state
         """
-        turn_actions = []
         # update the dialog state
         self.state_update(inputs, conf)
-        state = self.state.state_summary()
+        return self.respond()
+
+    def respond(self, summarize=True):
+        """
+        Generate the response to the inputs of the last state_update.
+
+        :param summarize: compute the state summary. The state is None if False.
+        :return: reward, terminal, [Action], state
+        """
+        self.begin_response(summarize)
         while True:
-            action = self.policy()
+            result = self.take(self.policy())
+            if result is not None:
+                return result
+
+    def begin_response(self, summarize=True):
+        """
+        Start the response to the inputs of the last state_update. The decisions of the response are then given to
+        take one at a time, which lets a policy outside the system make them.
+
+        :param summarize: compute the state summary. The state is None if False.
+        """
+        self.turn_actions = []
+        self.turn_state = self.state.state_summary() if summarize else None
+
+    def take(self, action):
+        """
+        Add the next decision to the current response. A GOODBYE ends the dialog and an INFORM delivers the pending
+        KB return, as they do in policy.
+
+        :param action: an Action, a list of Action or None
+        :return: reward, terminal, [Action], state if the decision ends the response, otherwise None
+        """
+        turn_actions = self.turn_actions
+        if action is not None:
+            if type(action) is list:
+                turn_actions.extend(action)
+            else:
+                action = [action]
+                turn_actions.extend(action)
+
+            for a in action:
+                if a.act == SystemAct.GOODBYE:
+                    self.state.spk_state = State.EXIT
+                elif a.act == SystemAct.INFORM:
+                    self.state.pending_return = None
 
-            if action is not None:
-                if type(action) is list:
-                    turn_actions.extend(action)
-                else:
-                    turn_actions.append(action)
+            self.update_grounding(action)
 
-                self.update_grounding(action)
+        if self.state.is_terminal():
+            self.state.update_history(self.state.SYS, turn_actions)
+            return 0.0, True, turn_actions, self.turn_state
 
-            if self.state.is_terminal():
-                self.state.update_history(self.state.SYS, turn_actions)
-                return 0.0, True, turn_actions, state
+        if not action:
+            # the same state would give the same decision again
+            raise ValueError("The policy gave no action at turn %d" % self.state.turn_id())
 
-            if self.state.yield_floor(turn_actions):
-                self.state.update_history(self.state.SYS, turn_actions)
-                return 0.0, False, turn_actions, state
+        if self.state.yield_floor(turn_actions):
+            self.state.update_history(self.state.SYS, turn_actions)
+            return 0.0, False, turn_actions, self.turn_state
+        return None
@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
-from simdial.agent.core import Agent, Action, UserAct, SystemAct, BaseSysSlot, BaseUsrSlot, State
+from simdial.agent.core import Agent, Action, UserAct, SystemAct, BaseSysSlot, BaseUsrSlot, State, DialogHistory
 import logging
 import numpy as np
-import copy
 from collections import OrderedDict
 
 
@@ -22,25 +21,18 @@ class User(Agent):
         """
         The dialog state object for this user simulator
 
-        :ivar history: a list of tuple [(speaker, actions) ... ]
+        :ivar history: a DialogHistory of (speaker, actions) turns
         :ivar spk_state: LISTEN, SPEAK or EXIT
         :ivar goals_met: if the system propose anything that's in user's goal
         :ivar: input_buffer: a list of system action that is not being handled in this turn
         """
         def __init__(self, sys_goals):
             super(State, self).__init__()
-            self.history = []
+            self.history = DialogHistory()
             self.spk_state = self.LISTEN
             self.input_buffer = []
             self.goals_met = OrderedDict([(g, False) for g in sys_goals])
 
-        def update_history(self, speaker, actions):
-            """
-            :param speaker: SYS or USR
-            :param actions: a list of Action
-            """
-            self.history.append((speaker, actions))
-
         def is_terminal(self):
             """
             :return: the user wants to terminate the session
@@ -77,12 +69,23 @@ class User(Agent):
         def reset_goal(self, sys_goals):
             self.goals_met = {g: False for g in sys_goals}
 
-    def __init__(self, domain, complexity):
+    def __init__(self, domain, complexity, rng=np.random, goal=None):
+        """
+        :param rng: a numpy RandomState for all the random choices of this user. The global RNG by default.
+        :param goal: a UserGoal planned by a GoalPlanner. The goals are sampled with rng if None.
+        """
         super(User, self).__init__(domain, complexity)
-        # 随机的选择目的槽位的个数
-        self.goal_cnt = np.random.choice(complexity.multi_goals.keys(), p=complexity.multi_goals.values())
+        self.rng = rng
+        self.goal = goal
         self.goal_ptr = 0           # 目的槽的指针
-        self.usr_constrains, self.sys_goals = self._sample_goal()       # 采样目标和用户约束
+        if goal is None:
+            # 随机的选择目的槽位的个数
+            self.goal_cnt = self.rng.choice(complexity.multi_goals.keys(), p=complexity.multi_goals.values())
+            self.usr_constrains, self.sys_goals = self._sample_goal()       # 采样目标和用户约束
+        else:
+            self.goal_cnt = goal.goal_cnt
+            self.usr_constrains = {k: v for k, v in goal.usr_constrains.items()}
+            self.sys_goals = list(goal.sys_goals[0])
         self.state = self.DialogState(self.sys_goals)                   # 使用系统目的槽列表初始化对话状态
 
     def state_update(self, sys_actions):
@@ -93,25 +96,25 @@ class User(Agent):
         """
         self.state.update_history(self.state.SYS, sys_actions)    # 更新对话历史
         self.state.spk_state = self.DialogState.SPEAK             # 当前状态为正在进行
-        self.state.input_buffer = copy.deepcopy(sys_actions)      # 将系统动作列表作为输入缓存
+        self.state.input_buffer = list(sys_actions)               # 将系统动作列表作为输入缓存
 
     def _sample_goal(self):
         """
         :return: {slot_name -> value} for user constrains, [slot_name, ..] for system goals
         """
-        temp_constrains = self.domain.db.sample_unique_row().tolist()     # 从数据库中采样一个用户约束
+        temp_constrains = self.domain.db.sample_unique_row(self.rng).tolist()     # 从数据库中采样一个用户约束
         # 根据复杂阈值随机的指定某些槽位时可以忽略的(值为none)
-        temp_constrains = [None if np.random.rand() < self.complexity.dont_care
+        temp_constrains = [None if self.rng.rand() < self.complexity.dont_care
                            else c for c in temp_constrains]
         # 将采样到的约束值复制给当前领域的usr_slots
         usr_constrains = {s.name: temp_constrains[i] for i, s in enumerate(self.domain.usr_slots)}
 
         # 随机的选取 goal slot的个数
-        num_interest = np.random.randint(0, len(self.domain.sys_slots)-1)
+        num_interest = self.rng.randint(0, len(self.domain.sys_slots)-1)
         goal_candidates = [s.name for s in self.domain.sys_slots if s.name != BaseSysSlot.DEFAULT]
         # 选出这些goal
-        selected_goals = np.random.choice(goal_candidates, size=num_interest, replace=False)
-        np.random.shuffle(selected_goals)
+        selected_goals = self.rng.choice(goal_candidates, size=num_interest, replace=False)
+        self.rng.shuffle(selected_goals)
         sys_goals = [BaseSysSlot.DEFAULT] + selected_goals.tolist()
         return usr_constrains, sys_goals
 
@@ -134,12 +137,16 @@ class User(Agent):
             return None
         else:
             self.goal_ptr += 1
-            _, self.sys_goals = self._sample_goal()
-            change_key = np.random.choice(self.usr_constrains.keys())
-            change_slot = self.domain.get_usr_slot(change_key)
+            if self.goal is None:
+                _, self.sys_goals = self._sample_goal()
+                change_key = self.rng.choice(self.usr_constrains.keys())
+                change_slot = self.domain.get_usr_slot(change_key)
+                new_value = self.rng.randint(0, change_slot.dim-1) % change_slot.dim
+            else:
+                self.sys_goals = list(self.goal.sys_goals[self.goal_ptr])
+                change_key, new_value = self.goal.flips[self.goal_ptr-1]
             old_value = self.usr_constrains[change_key]
             old_value = -1 if old_value is None else old_value
-            new_value = np.random.randint(0, change_slot.dim-1) % change_slot.dim
             self.logger.info("Filp user constrain %s from %d to %d" %
                              (change_key, old_value, new_value))
             self.usr_constrains[change_key] = new_value
@@ -183,8 +190,8 @@ class User(Agent):
                     return None
                 else:
                     # 不满足,则选择 否认曹值动作 或是 否认曹值动作 + 提供正确的曹值
-                    strategy = np.random.choice(self.complexity.reject_style.keys(),
-                                                p=self.complexity.reject_style.values())
+                    strategy = self.rng.choice(self.complexity.reject_style.keys(),
+                                               p=self.complexity.reject_style.values())
                     if strategy == "reject":
                         return Action(UserAct.DISCONFIRM, (slot_type, slot_val))
                     elif strategy == "reject+inform":
@@ -238,10 +245,10 @@ class User(Agent):
                     #下一个goal不为空
                     ack_act = Action(UserAct.MORE_REQUEST, [(g, None) for g in complete_goals])
                     # 随机的返回是否是yes or no问题 ，就是用户提供一个goal值，问系统是不是
-                    if np.random.rand() < self.complexity.yn_question:
+                    if self.rng.rand() < self.complexity.yn_question:
                         # find a system slot with yn_templates
                         slot = self.domain.get_sys_slot(next_goal)
-                        expected_val = np.random.randint(0, slot.dim)
+                        expected_val = self.rng.randint(0, slot.dim)
                         if len(slot.yn_questions.get(slot.vocabulary[expected_val], [])) > 0:
                             # sample a expected value
                             return [ack_act, Action(UserAct.YN_QUESTION, (slot.name, expected_val))]
@@ -273,14 +280,14 @@ class User(Agent):
             elif self.domain.is_usr_slot(slot_type):
                 # 采样出随机个数的多余槽位，将动作排在当前槽位之后inform
                 if len(self.domain.usr_slots) > 1:
-                    num_informs = np.random.choice(self.complexity.multi_slots.keys(),
-                                                   p=self.complexity.multi_slots.values(),
-                                                   replace=False)
+                    num_informs = self.rng.choice(self.complexity.multi_slots.keys(),
+                                                  p=self.complexity.multi_slots.values(),
+                                                  replace=False)
                     if num_informs > 1:
                         candidates = [k for k, v in self.usr_constrains.items() if k != slot_type and v is not None]
                         num_extra = min(num_informs-1, len(candidates))
                         if num_extra > 0:
-                            extra_keys = np.random.choice(candidates, size=num_extra, replace=False)
+                            extra_keys = self.rng.choice(candidates, size=num_extra, replace=False)
                             actions = [Action(UserAct.INFORM, (key, self.usr_constrains[key])) for key in extra_keys]
                             actions.insert(0, Action(UserAct.INFORM, (slot_type, self.usr_constrains[slot_type])))
                             return actions
@@ -308,25 +315,20 @@ class User(Agent):
 
             if last_usr_actions is None:
                 raise ValueError("Unexpected ask rephrase")
-            for a in last_usr_actions:
-                a.add_parameter(BaseUsrSlot.AGAIN, True)
-            return last_usr_actions
+            return [a.with_added_parameter(BaseUsrSlot.AGAIN, True) for a in last_usr_actions]
 
         # 如果系统是query 问满足约束的goal值是不是你要的，
         # 就从数据库中采样出goals的值，并告诉系统
         elif top_action.act == SystemAct.QUERY:
             query, goals = top_action.parameters[0], top_action.parameters[1]
-            valid_entries = self.domain.db.select([v for name, v in query])
-            chosen_entry = valid_entries[np.random.randint(0, len(valid_entries)), :]
+            chosen_entry = self.domain.db.sample_match([v for name, v in query], self.rng)
+            if chosen_entry is None:
+                raise ValueError("No valid entries")
 
             results = {}
-            if chosen_entry.shape[0] > 0:
-                for goal in goals:
-                    _, slot_id = self.domain.get_sys_slot(goal, return_idx=True)
-                    results[goal] = chosen_entry[slot_id]
-            else:
-                print(chosen_entry)
-                raise ValueError("No valid entries")
+            for goal in goals:
+                _, slot_id = self.domain.get_sys_slot(goal, return_idx=True)
+                results[goal] = int(chosen_entry[slot_id])
 
             return Action(UserAct.KB_RETURN, [query, results])
         else:
@@ -337,7 +339,8 @@ class User(Agent):
         Given a list of inputs from the system, generate a response
 
         :param inputs: a list of Action
-        :return: reward, terminal, [Action]
+        :return: reward, terminal, [Action]. The reward is 1.0 if the user ends the dialog with all its goals met,
+        -1.0 if it ends it with unmet goals, and 0.0 if the dialog goes on.
         """
         turn_actions = []
         # update the dialog state
@@ -351,10 +354,134 @@ class User(Agent):
                     turn_actions.append(action)
 
             if self.state.is_terminal():
-                reward = 1.0 if self.state.unmet_goal() is None else -1.0
                 self.state.update_history(self.state.USR, turn_actions)
-                return reward, True, turn_actions
+                return self.goal_reward(), True, turn_actions
 
             if self.state.yield_floor():
                 self.state.update_history(self.state.USR, turn_actions)
+                if any(a.act == UserAct.GOODBYE for a in turn_actions):
+                    return self.goal_reward(), False, turn_actions
                 return 0.0, False, turn_actions
+
+    def goal_reward(self):
+        """
+        :return: the reward of ending the dialog now
+        """
+        return 1.0 if self.state.unmet_goal() is None else -1.0
+
+
+class UserGoal(object):
+    """
+    The goals of one user, sampled in advance by a GoalPlanner.
+
+    :ivar goal_cnt: the number of goals
+    :ivar usr_constrains: {slot_name -> value} for the user constrains of the first goal, None for dont care
+    :ivar sys_goals: the system goals of every goal, [[slot_name, ..], ..]
+    :ivar flips: the (slot_name, new value) of the user constrain that changes at the start of every goal after the
+    first one
+    """
+
+    def __init__(self, goal_cnt, usr_constrains, sys_goals, flips):
+        self.goal_cnt = goal_cnt
+        self.usr_constrains = usr_constrains
+        self.sys_goals = sys_goals
+        self.flips = flips
+
+
+class GoalPlanner(object):
+    """
+    Sample the goals of all the users of a corpus, a block of dialogs at a time, in a few vectorized operations
+    instead of many small ones per User. The goals of block k are drawn from RandomState([seed, k, GOAL_STREAM]), so
+    the goal of a dialog only depends on the corpus seed and its index, like the random streams of
+    Generator.session_rngs.
+
+    The goals follow the distribution of User._sample_goal and User._increment_goal, but they are different draws, and
+    the users do not draw them from their own stream. A corpus with planned goals is therefore a different corpus than
+    one without.
+
+    A plan is a dict of arrays with one row per dialog:
+
+    - goal_cnt: the number of goals : int [num_dialogs]
+    - usr_constrains: the user constrains of the first goal, -1 for dont care : int [num_dialogs, num_usr_slots]
+    - num_interest: the number of system goals of every goal besides the default one : int [num_dialogs, max_cnt]
+    - goal_order: the system goal candidates of every goal in a random order, of which the first num_interest are
+      the system goals : int [num_dialogs, max_cnt, num_sys_slots-1]
+    - flip_slot: the user slot that changes at the start of every goal after the first : int [num_dialogs, max_cnt-1]
+    - flip_value: its new value : int [num_dialogs, max_cnt-1]
+
+    :ivar block_size: the number of dialogs per block
+    :cvar GOAL_STREAM: the id of the random stream of the goals
+    :cvar BLOCK_SIZE: the default block_size
+    """
+    GOAL_STREAM = 2
+    BLOCK_SIZE = 1000
+
+    def __init__(self, domain, complexity, seed, block_size=BLOCK_SIZE):
+        self.domain = domain
+        self.complexity = complexity
+        self.seed = seed
+        self.block_size = block_size
+        self.candidates = [s.name for s in domain.sys_slots if s.name != BaseSysSlot.DEFAULT]
+        self.dims = np.array([s.dim for s in domain.usr_slots])
+        self._block = None          # (block id, plan) of the last block
+
+    def sample(self, num_dialogs, rng=np.random):
+        """
+        :param num_dialogs: the number of dialogs
+        :param rng: a numpy RandomState
+        :return: a plan of num_dialogs dialogs
+        """
+        multi_goals = self.complexity.multi_goals
+        goal_cnt = rng.choice(list(multi_goals.keys()), size=num_dialogs, p=list(multi_goals.values()))
+        max_cnt = max(max(multi_goals.keys()), 1)
+
+        usr_constrains = self.domain.db.sample_unique_rows(num_dialogs, rng).astype(np.int64)
+        usr_constrains[rng.rand(*usr_constrains.shape) < self.complexity.dont_care] = -1
+
+        # num_interest of a random order is a choice without replacement followed by a shuffle
+        num_interest = rng.randint(0, len(self.domain.sys_slots)-1, size=(num_dialogs, max_cnt))
+        goal_order = np.argsort(rng.rand(num_dialogs, max_cnt, len(self.candidates)), axis=-1)
+
+        flip_slot = rng.randint(0, len(self.dims), size=(num_dialogs, max_cnt-1))
+        flip_value = (rng.rand(num_dialogs, max_cnt-1) * (self.dims[flip_slot]-1)).astype(np.int64)
+
+        return {'goal_cnt': goal_cnt, 'usr_constrains': usr_constrains, 'num_interest': num_interest,
+                'goal_order': goal_order, 'flip_slot': flip_slot, 'flip_value': flip_value}
+
+    def block(self, block_id):
+        """
+        :return: the plan of the dialogs with index in [block_id*block_size, (block_id+1)*block_size)
+        """
+        if self._block is None or self._block[0] != block_id:
+            rng = np.random.RandomState([self.seed, block_id, self.GOAL_STREAM])
+            self._block = (block_id, self.sample(self.block_size, rng))
+        return self._block[1]
+
+    def plan(self, start, stop):
+        """
+        :return: the plan of the dialogs with index in [start, stop), e.g. to inspect the goals of a corpus
+        """
+        parts = []
+        for block_id in range(start // self.block_size, (stop-1) // self.block_size + 1):
+            lo = max(start - block_id * self.block_size, 0)
+            hi = min(stop - block_id * self.block_size, self.block_size)
+            parts.append({k: v[lo:hi] for k, v in self.block(block_id).items()})
+        return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]} if parts else {}
+
+    def goal(self, index):
+        """
+        :param index: the index of a dialog in the corpus
+        :return: the UserGoal of the dialog
+        """
+        block_id, row = divmod(index, self.block_size)
+        plan = self.block(block_id)
+        usr_slots = self.domain.usr_slots
+        constrains = plan['usr_constrains'][row].tolist()
+        usr_constrains = {s.name: None if constrains[i] < 0 else constrains[i] for i, s in enumerate(usr_slots)}
+
+        sys_goals = []
+        for order, num_interest in zip(plan['goal_order'][row], plan['num_interest'][row]):
+            sys_goals.append([BaseSysSlot.DEFAULT] + [self.candidates[j] for j in order[:num_interest]])
+        flips = [(usr_slots[slot].name, int(value))
+                 for slot, value in zip(plan['flip_slot'][row], plan['flip_value'][row])]
+        return UserGoal(int(plan['goal_cnt'][row]), usr_constrains, sys_goals, flips)
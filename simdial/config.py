@@ -4,3 +4,7 @@
 
 class Config(object):
     debug = False
+    # the folder that Domain looks up database snapshots in by digest
+    kb_dir = "kb"
+    # the number of recent turns a DialogHistory keeps, None for all of them. It keeps all of them in debug mode.
+    history_window = 0
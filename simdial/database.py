@@ -1,6 +1,82 @@
 #-*-encoding:utf-8-*-
 import numpy as np
+import threading
+import sqlite3
+import atexit
+import shutil
+import hashlib
+import tempfile
 import logging
+import json
+import os
+from collections import OrderedDict
+
+
+def _remove_mmap_dir(path, pid):
+    # a forked child inherits the exit handlers of its parent, and must not remove the files the parent still uses
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class QueryCache(object):
+    """
+    A LRU cache of query results. It is bounded by the total size of the cached arrays rather than by the number
+    of queries, since the result of a broad query on a big table can take as much memory as the table.
+
+    :ivar max_bytes: the max total nbytes of the cached arrays. 0 disables the cache.
+    :ivar nbytes: the total nbytes of the cached arrays
+    :ivar hits: the number of lookups answered from the cache
+    :ivar misses: the number of lookups that were not
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        :return: the cached array of key, or None. A hit makes key the most recently used.
+        """
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = value
+        return value
+
+    def peek(self, key):
+        """
+        :return: the cached array of key, or None, without counting the lookup or touching the LRU order
+        """
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        """
+        Cache a read-only array, and evict the least recently used ones until the cache fits in max_bytes.
+        An array larger than max_bytes is not cached.
+        """
+        if value.nbytes > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
 
 
 class Database(object):
@@ -15,17 +91,41 @@ class Database(object):
     :ivar usr_modalities: the vocab size of each column : List                        每个colum的词典长度
     :ivar usr_pdf: the PDF for each columns : 2D list                                 每个 colum 的分布
     :ivar num_rows: the number of entries                                             entries的个数
-    :ivar table: the content : 2D list [[] *num_rows]
-    :ivar indexes: for efficient SELECT : [{attribute_word -> corresponding rows}]    索引字典 attribute word -> 对应的 rows
+    :ivar table: the content : 2D array [num_rows, num_usr_slots] of the smallest unsigned dtype for the modalities
+    :ivar sys_table: the UID and the non-searchable attributes : 2D array [num_rows, 1+num_sys_slots]
+    :ivar value_counts: the number of rows with each value : [int array [modality]]   每个属性值出现的次数
+    :ivar indexes: for efficient SELECT : [uint8 array [modality, num_bytes]]         每个属性值对应的 rows 的 bitset
+    Row r of a column matches value v if bit r of indexes[col][v] is set (np.packbits order).
+    :ivar all_rows: the bitset of all rows : uint8 array [num_bytes]
+    :ivar unique_rows: the distinct rows of table, sorted : 2D array                  去重后的 table
+    :ivar query_cache: LRU cache of normalized query -> row indexes : QueryCache        查询结果缓存
+    :ivar count_cube: the number of rows that satisfy each query, or None : array [modality_0, ..., modality_k]
+    Value 0 of an axis is don't care and value v > 0 means the column is not v, like in select_bits.
+    :ivar shared_dir: the folder of the .npy files the big arrays are memory mapped from, or None. See share.
+    :ivar mmap_dir: the temporary folder of the np.memmap tables of this process, or None. See close.
+    :cvar CACHE_BYTES: the default max total size of the row indexes in query_cache
+    :cvar POPCOUNT: the number of set bits of each uint8 value
+    :cvar CUBE_CELLS: the default max number of cells in count_cube
     """
 
     logger = logging.getLogger(__name__)
+    CACHE_BYTES = 64 * 2**20
+    # the number of set bits of every byte value
+    POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+    CUBE_CELLS = 2**16
 
-    def __init__(self, usr_dirichlet_priors, sys_dirichlet_priors, num_rows):
+    def __init__(self, usr_dirichlet_priors, sys_dirichlet_priors, num_rows, rng=np.random, cache_bytes=CACHE_BYTES,
+                 mmap_dir=None, cube_cells=CUBE_CELLS):
         """
         :param usr_dirichlet_priors: 2D list [[]_0, []_1, ... []_k] for each searchable attributes
         :param sys_dirichlet_priors: 2D llst for each entry (non-searchable attributes)
         :param num_rows: the number of row in the database
+        :param rng: a numpy RandomState to sample the PDFs and the table
+        :param cache_bytes: the max total size in bytes of the cached query results. 0 disables the cache.
+        :param mmap_dir: if given, table and sys_table are np.memmap files in a new folder under this one instead of
+        in memory, so any number of databases and processes can use the same mmap_dir. The new folder is removed by
+        close, or when the process exits.
+        :param cube_cells: build count_cube if it has at most this many cells. 0 disables it.
         """
         self.usr_dirichlet_priors = usr_dirichlet_priors
         self.sys_dirichlet_priors = sys_dirichlet_priors
@@ -37,45 +137,325 @@ class Database(object):
         self.sys_modalities = [len(p) for p in sys_dirichlet_priors]
 
         # sample attr_pdf for each attribute from the dirichlet prior
-        self.usr_pdf = [np.random.dirichlet(d_p) for d_p in self.usr_dirichlet_priors]
-        self.sys_pdf = [np.random.dirichlet(d_p) for d_p in self.sys_dirichlet_priors]
+        self.usr_pdf = [rng.dirichlet(d_p) for d_p in self.usr_dirichlet_priors]
+        self.sys_pdf = [rng.dirichlet(d_p) for d_p in self.sys_dirichlet_priors]
         self.num_rows = num_rows
 
-        # begin to generate the table
-        usr_table, usr_index = self._gen_table(self.usr_pdf, self.usr_modalities, self.num_usr_slots, num_rows)
-        sys_table, sys_index = self._gen_table(self.sys_pdf, self.sys_modalities, self.num_sys_slots, num_rows)
+        # begin to generate the table. The UID is the first column of sys_table
+        if mmap_dir is not None:
+            mmap_dir = tempfile.mkdtemp(prefix="db-", dir=mmap_dir)
+            atexit.register(_remove_mmap_dir, mmap_dir, os.getpid())
+        self.mmap_dir = mmap_dir
+        self.table = self._alloc_table(mmap_dir, "usr_table", num_rows, self.num_usr_slots, self.usr_modalities)
+        self.sys_table = self._alloc_table(mmap_dir, "sys_table", num_rows, 1+self.num_sys_slots,
+                                           [num_rows] + self.sys_modalities)
+        self.value_counts = self._gen_table(self.table, self.usr_pdf, self.usr_modalities, rng)
+        self._gen_table(self.sys_table[:, 1:], self.sys_pdf, self.sys_modalities, rng)
+        self.sys_table[:, 0] = np.arange(num_rows)
+        if mmap_dir is not None:
+            self.table.flush()
+            self.sys_table.flush()
 
-        # append the UID in the first column
-        sys_table.insert(0, range(self.num_rows))
+        self.indexes = [self._gen_index(self.table[:, idx], m) for idx, m in enumerate(self.usr_modalities)]
+        self.all_rows = np.packbits(np.ones(num_rows, dtype=bool))
+        self.unique_rows = self._unique_rows(self.table, self.usr_modalities)
+        self.count_cube = self._gen_cube(self.table, self.usr_modalities, cube_cells)
+        self.shared_dir = None
+        # the table never changes after it is built, so query results can be cached
+        self.query_cache = QueryCache(cache_bytes)
 
-        self.table = np.array(usr_table).transpose()
-        self.indexes = usr_index
-        self.sys_table = np.array(sys_table).transpose()
+    @property
+    def cache_hits(self):
+        """
+        :return: the number of queries answered by query_cache
+        """
+        return self.query_cache.hits
+
+    @property
+    def cache_misses(self):
+        """
+        :return: the number of queries computed from indexes
+        """
+        return self.query_cache.misses
 
     @staticmethod
-    def _gen_table(pdf, modalities, num_cols, num_rows):
-        list_table = []
-        indexes = []
-        for idx in range(num_cols):
-            col = np.random.choice(range(modalities[idx]), p=pdf[idx], size=num_rows)
-            list_table.append(col)
-            # indexing
-            index = {}
-            for m_id in range(modalities[idx]):
-                matched_list = np.squeeze(np.argwhere(col == m_id)).tolist()
-                matched_list = set(matched_list) if type(matched_list) is list else {matched_list}
-                index[m_id] = matched_list
-            indexes.append(index)
-        return list_table, indexes
-
-    def sample_unique_row(self):
+    def _alloc_table(mmap_dir, name, num_rows, num_cols, modalities):
+        """
+        :return: an empty 2D array of the smallest unsigned dtype that holds every value of every column
+        """
+        dtype = np.min_scalar_type(max([m-1 for m in modalities] + [0]))
+        if mmap_dir is None:
+            return np.empty((num_rows, num_cols), dtype=dtype)
+        return np.memmap(os.path.join(mmap_dir, name + ".dat"), dtype=dtype, mode="w+", shape=(num_rows, num_cols))
+
+    @staticmethod
+    def _gen_table(table, pdf, modalities, rng):
+        """
+        Fill each column of table by sampling from its PDF.
+
+        :return: the number of rows with each value, for each column
+        """
+        value_counts = []
+        for idx in range(table.shape[1]):
+            table[:, idx] = rng.choice(modalities[idx], p=pdf[idx], size=table.shape[0])
+            value_counts.append(np.bincount(table[:, idx], minlength=modalities[idx]))
+        return value_counts
+
+    @staticmethod
+    def _gen_index(col, modality):
+        """
+        :return: a packed bitset of the matched rows for each value : uint8 array [modality, num_bytes]
+        """
+        # the bits of a byte are distinct, so OR-ing them is a sum, and all bytes of all values are one bincount
+        rows = np.arange(len(col))
+        num_bytes = (len(col) + 7) // 8
+        byte_ids = col.astype(np.int64) * num_bytes + (rows >> 3)
+        index = np.bincount(byte_ids, weights=128 >> (rows & 7), minlength=modality*num_bytes)
+        return index.astype(np.uint8).reshape(modality, num_bytes)
+
+    @staticmethod
+    def _gen_cube(table, modalities, max_cells):
+        """
+        :return: the count_cube of table, or None if it would have more than max_cells cells
+        """
+        if not modalities or np.prod([float(m) for m in modalities]) > max_cells:
+            return None
+        # the number of rows with each combination of values, then each axis is turned from "equal to v"
+        # into "not equal to v", except value 0 that becomes the don't care marginal
+        cube = np.zeros(modalities, dtype=np.int64)
+        np.add.at(cube, tuple(table[:, idx] for idx in range(table.shape[1])), 1)
+        for axis in range(cube.ndim):
+            total = cube.sum(axis=axis, keepdims=True)
+            cube = total - cube
+            cube[(slice(None),) * axis + (0,)] = total.squeeze(axis)
+        return cube.astype(np.min_scalar_type(table.shape[0]))
+
+    @staticmethod
+    def _unique_rows(table, modalities):
+        """
+        :return: the distinct rows of table in the same order as np.unique(table, axis=0)
+        """
+        # encode each row as one mixed radix integer with the first column as the most significant digit
+        if np.prod([float(m) for m in modalities]) >= 2**63:
+            return np.unique(table, axis=0)
+        strides = np.cumprod([1] + modalities[:0:-1])[::-1]
+        keys = np.zeros(table.shape[0], dtype=np.int64)
+        for idx, stride in enumerate(strides):
+            keys += table[:, idx].astype(np.int64) * stride
+        keys = np.unique(keys)
+        unique_rows = np.empty((len(keys), table.shape[1]), dtype=table.dtype)
+        for idx, (stride, m) in enumerate(zip(strides, modalities)):
+            unique_rows[:, idx] = keys // stride % m
+        return unique_rows
+
+    def digest(self):
+        """
+        :return: the hex SHA-1 of the PDFs and the tables, which identifies a snapshot of this database
+        """
+        sha = hashlib.sha1()
+        for array in self.usr_pdf + self.sys_pdf + [self.table, self.sys_table]:
+            array = np.ascontiguousarray(array)
+            sha.update(("%s%s" % (array.dtype.str, array.shape)).encode('ascii'))
+            sha.update(array.tobytes())
+        return sha.hexdigest()
+
+    def save(self, path):
+        """
+        Save the priors, PDFs, tables and indexes to one .npz file.
+
+        :param path: the file to write, or a folder to write <digest>.npz in
+        :return: the path of the snapshot
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, self.digest() + ".npz")
+        arrays = {'table': self.table, 'sys_table': self.sys_table, 'all_rows': self.all_rows,
+                  'unique_rows': self.unique_rows}
+        # the priors and PDFs are ragged, so every column is stored under its own key
+        for prefix, columns in [('usr_prior', self.usr_dirichlet_priors), ('sys_prior', self.sys_dirichlet_priors),
+                                ('usr_pdf', self.usr_pdf), ('sys_pdf', self.sys_pdf),
+                                ('value_count', self.value_counts), ('index', self.indexes)]:
+            for idx, column in enumerate(columns):
+                arrays['%s_%d' % (prefix, idx)] = column
+        # write to a file object so that numpy keeps the name as it is
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path, kb_dir=None, cache_bytes=CACHE_BYTES, cube_cells=CUBE_CELLS):
         """
+        Load a snapshot written by save.
+
+        :param path: the .npz file, or the digest of a snapshot in kb_dir
+        :param kb_dir: the folder to look up digests in
+        :param cache_bytes: the max total size in bytes of the cached query results. 0 disables the cache.
+        :param cube_cells: build count_cube if it has at most this many cells. 0 disables it.
+        :return: a Database
+        """
+        if not os.path.isfile(path) and kb_dir is not None:
+            path = os.path.join(kb_dir, path + ".npz")
+        if not os.path.isfile(path):
+            raise ValueError("No database snapshot at %s" % path)
+
+        with np.load(path) as arrays:
+            def columns(prefix):
+                num_cols = len([k for k in arrays.files if k.startswith(prefix + '_')])
+                return [arrays['%s_%d' % (prefix, idx)] for idx in range(num_cols)]
+
+            db = cls.__new__(cls)
+            db.usr_dirichlet_priors = columns('usr_prior')
+            db.sys_dirichlet_priors = columns('sys_prior')
+            db.num_usr_slots = len(db.usr_dirichlet_priors)
+            db.usr_modalities = [len(p) for p in db.usr_dirichlet_priors]
+            db.num_sys_slots = len(db.sys_dirichlet_priors)
+            db.sys_modalities = [len(p) for p in db.sys_dirichlet_priors]
+            db.usr_pdf = columns('usr_pdf')
+            db.sys_pdf = columns('sys_pdf')
+            db.table = arrays['table']
+            db.sys_table = arrays['sys_table']
+            db.num_rows = db.table.shape[0]
+            db.value_counts = columns('value_count')
+            db.indexes = columns('index')
+            db.all_rows = arrays['all_rows']
+            db.unique_rows = arrays['unique_rows']
+        db.count_cube = cls._gen_cube(db.table, db.usr_modalities, cube_cells)
+        db.shared_dir = None
+        db.mmap_dir = None
+        db.query_cache = QueryCache(cache_bytes)
+        return db
+
+    def share(self, dirname):
+        """
+        Move the tables, indexes and unique rows to .npy files in dirname and memory map them read-only.
+        A shared Database pickles only the file names, so every process that unpickles it maps the same pages
+        instead of holding its own copy.
+
+        :param dirname: an existing folder that outlives every process using this database
+        """
+        for name, array in self._shared_arrays():
+            np.save(os.path.join(dirname, name + ".npy"), array)
+        self._attach(dirname)
+        # the tables are mapped from dirname now
+        self.close()
+
+    def _shared_arrays(self):
+        arrays = [('table', self.table), ('sys_table', self.sys_table), ('unique_rows', self.unique_rows)]
+        return arrays + [('index_%d' % idx, index) for idx, index in enumerate(self.indexes)]
+
+    def _attach(self, dirname):
+        def load(name):
+            return np.load(os.path.join(dirname, name + ".npy"), mmap_mode='r')
+
+        self.table = load('table')
+        self.sys_table = load('sys_table')
+        self.unique_rows = load('unique_rows')
+        self.indexes = [load('index_%d' % idx) for idx in range(self.num_usr_slots)]
+        self.shared_dir = dirname
+
+    def close(self):
+        """
+        Remove mmap_dir, the folder of the memory mapped tables, if there is one. The tables stay readable, since
+        the mapped files are only unlinked.
+        """
+        if self.mmap_dir is not None:
+            _remove_mmap_dir(self.mmap_dir, os.getpid())
+            self.mmap_dir = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # every process starts with an empty cache
+        state['query_cache'] = QueryCache(self.query_cache.max_bytes)
+        # the folder belongs to this process, the copy holds the tables themselves
+        state['mmap_dir'] = None
+        if self.shared_dir is not None:
+            for name in ['table', 'sys_table', 'unique_rows', 'indexes']:
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_dir is not None:
+            self._attach(self.shared_dir)
+
+    def sample_unique_row(self, rng=np.random):
+        """
+        :param rng: a numpy RandomState
         :return: a unique row in the searchable table
         """
-        unique_rows = np.unique(self.table, axis=0)
-        idxes = range(len(unique_rows))
-        np.random.shuffle(idxes)
-        return unique_rows[idxes[0]]
+        return self.unique_rows[rng.randint(0, len(self.unique_rows))]
+
+    def sample_unique_rows(self, num_samples, rng=np.random):
+        """
+        :param num_samples: the number of rows
+        :param rng: a numpy RandomState
+        :return: 2D array [num_samples, num_usr_slots], each row drawn uniformly from the unique rows
+        """
+        return self.unique_rows[rng.randint(0, len(self.unique_rows), size=num_samples)]
+
+    def select_bits(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the bitset of the rows that satisfy all constrains
+        """
+        valid_bits = self.all_rows.copy()
+        for q, a_id in zip(query, range(self.num_usr_slots)):
+            if q:
+                np.bitwise_and(valid_bits, np.invert(self.indexes[a_id][q]), out=valid_bits)
+                if not valid_bits.any():
+                    break
+        return valid_bits
+
+    def select_index(self, query):
+        """
+        Like select_bits, but return the row indexes. Results are kept in query_cache.
+
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the read-only array of the indexes of the rows that satisfy all constrains
+        """
+        # None and 0 are both don't care in select_bits
+        key = tuple(q if q else None for q in query)
+        valid_idx = self.query_cache.get(key)
+        if valid_idx is not None:
+            return valid_idx
+
+        valid_idx = np.flatnonzero(np.unpackbits(self.select_bits(query))[:self.num_rows])
+        valid_idx.flags.writeable = False
+        self.query_cache.put(key, valid_idx)
+        return valid_idx
+
+    def count(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the number of rows that satisfy all constrains
+        """
+        if self.count_cube is not None:
+            return int(self.count_cube[tuple(q if q else 0 for q in query[:self.num_usr_slots])])
+        valid_idx = self.query_cache.peek(tuple(q if q else None for q in query))
+        if valid_idx is not None:
+            return len(valid_idx)
+        return int(self.POPCOUNT[self.select_bits(query)].sum())
+
+    def exists(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: True if any row satisfies all constrains
+        """
+        if self.count_cube is None:
+            return bool(self.select_bits(query).any())
+        return self.count(query) > 0
+
+    def sample_match(self, query, rng=np.random):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :param rng: a numpy RandomState
+        :return: a uniformly random system entry that satisfies all constrains, or None if there is none
+        """
+        if self.count_cube is not None and not self.exists(query):
+            return None
+        valid_idx = self.select_index(query)
+        if len(valid_idx) == 0:
+            return None
+        return self.sys_table[valid_idx[rng.randint(0, len(valid_idx))]]
 
     def select(self, query, return_index=False):
         """
@@ -83,16 +463,10 @@ class Database(object):
 
         :param query: 1D [] equal to the number of attributes, None means don't care
         :param return_index: if return the db index
-        :return return a list system_entries and (optional)index that satisfy all constrains
+        :return return a list system_entries and (optional)index array that satisfy all constrains
 
         """
-        valid_idx = set(range(self.num_rows))
-        for q, a_id in zip(query, range(self.num_usr_slots)):
-            if q:
-                valid_idx -= self.indexes[a_id][q]
-                if len(valid_idx) == 0:
-                    break
-        valid_idx = list(valid_idx)
+        valid_idx = self.select_index(query)
         if return_index:
             return self.sys_table[valid_idx, :], valid_idx
         else:
@@ -104,4 +478,339 @@ class Database(object):
         """
 
         self.logger.info("DB contains %d rows (%d unique ones), with %d attributes"
-                         % (self.num_rows, len(np.unique(self.table, axis=0)), self.num_usr_slots))
+                         % (self.num_rows, len(self.unique_rows), self.num_usr_slots))
+
+
+class SqliteDatabase(object):
+    """
+    A Database stored in a SQLite file, for tables that do not fit in memory. It has the same query interface and
+    the same query semantics as Database, and it returns the same rows for the same random numbers.
+
+    The file has an entries table with the UID as primary key and one column per attribute, an index on every
+    searchable column, the sorted distinct searchable rows, and a meta table with the shape and the PDFs.
+
+    A query keeps the rows that differ from every given value, and a "!=" cannot be served by an index. So the
+    rows equal to a value are read with one index lookup into a packed bitset like the indexes of Database, and
+    the bitsets are kept in query_cache. A query is then answered like Database.select_bits, without a scan.
+
+    :ivar path: the SQLite file
+    :ivar num_usr_slots: the number of searchable columns
+    :ivar usr_modalities: the vocab size of each searchable column
+    :ivar num_sys_slots: the number of non-searchable columns
+    :ivar sys_modalities: the vocab size of each non-searchable column
+    :ivar usr_pdf: the PDF of each searchable column
+    :ivar sys_pdf: the PDF of each non-searchable column
+    :ivar num_rows: the number of entries
+    :ivar num_unique_rows: the number of distinct searchable rows
+    :ivar query_cache: LRU cache of (column, value) -> bitset of the rows with that value : QueryCache
+    :cvar EXTENSION: the file extension that open_database recognizes
+    :cvar CHUNK_SIZE: the number of rows generated or written at a time
+    :cvar MAX_VARIABLES: the max number of parameters in one statement
+    """
+
+    logger = logging.getLogger(__name__)
+    EXTENSION = ".sqlite"
+    CHUNK_SIZE = 100000
+    MAX_VARIABLES = 900
+
+    def __init__(self, path, cache_bytes=Database.CACHE_BYTES):
+        """
+        :param path: a SQLite file written by build or from_database
+        :param cache_bytes: the max total size in bytes of the cached bitsets. 0 disables the cache.
+        """
+        self.path = path
+        self.query_cache = QueryCache(cache_bytes)
+        self._pid = None
+        self._lock = threading.Lock()
+        self._connections = {}
+
+        meta = dict(self._connection().execute("SELECT key, value FROM meta").fetchall())
+        self.usr_modalities = json.loads(meta['usr_modalities'])
+        self.sys_modalities = json.loads(meta['sys_modalities'])
+        self.num_usr_slots = len(self.usr_modalities)
+        self.num_sys_slots = len(self.sys_modalities)
+        self.usr_pdf = [np.array(p) for p in json.loads(meta['usr_pdf'])]
+        self.sys_pdf = [np.array(p) for p in json.loads(meta['sys_pdf'])]
+        self.num_rows = int(meta['num_rows'])
+        self.num_unique_rows = int(meta['num_unique_rows'])
+        self.all_rows = np.packbits(np.ones(self.num_rows, dtype=bool))
+
+        self._usr_cols = ", ".join("usr_%d" % idx for idx in range(self.num_usr_slots))
+        self._sys_cols = ", ".join(["uid"] + ["sys_%d" % idx for idx in range(self.num_sys_slots)])
+
+    @classmethod
+    def build(cls, path, usr_dirichlet_priors, sys_dirichlet_priors, num_rows, rng=np.random,
+              chunk_size=CHUNK_SIZE):
+        """
+        Sample a new database into a SQLite file, chunk_size rows at a time.
+
+        :param path: the SQLite file to create
+        :param usr_dirichlet_priors: 2D list [[]_0, []_1, ... []_k] for each searchable attributes
+        :param sys_dirichlet_priors: 2D llst for each entry (non-searchable attributes)
+        :param num_rows: the number of row in the database
+        :param rng: a numpy RandomState to sample the PDFs and the table
+        :param chunk_size: the number of rows sampled at a time
+        :return: a SqliteDatabase
+        """
+        usr_pdf = [rng.dirichlet(d_p) for d_p in usr_dirichlet_priors]
+        sys_pdf = [rng.dirichlet(d_p) for d_p in sys_dirichlet_priors]
+
+        def chunks():
+            for start in range(0, num_rows, chunk_size):
+                size = min(chunk_size, num_rows - start)
+                usr_block = np.column_stack([rng.choice(len(p), p=p, size=size) for p in usr_pdf]
+                                            or [np.empty((size, 0), dtype=int)])
+                sys_block = np.column_stack([rng.choice(len(p), p=p, size=size) for p in sys_pdf]
+                                            or [np.empty((size, 0), dtype=int)])
+                yield usr_block, sys_block
+
+        cls._write(path, usr_pdf, sys_pdf, num_rows, chunks())
+        return cls(path)
+
+    @classmethod
+    def from_database(cls, database, path, chunk_size=CHUNK_SIZE):
+        """
+        Copy an in memory Database into a SQLite file.
+
+        :param database: a Database
+        :param path: the SQLite file to create
+        :param chunk_size: the number of rows written at a time
+        :return: a SqliteDatabase with the same content
+        """
+        def chunks():
+            for start in range(0, database.num_rows, chunk_size):
+                yield database.table[start:start+chunk_size], database.sys_table[start:start+chunk_size, 1:]
+
+        cls._write(path, database.usr_pdf, database.sys_pdf, database.num_rows, chunks())
+        return cls(path)
+
+    @staticmethod
+    def _write(path, usr_pdf, sys_pdf, num_rows, chunks):
+        usr_cols = ["usr_%d" % idx for idx in range(len(usr_pdf))]
+        sys_cols = ["sys_%d" % idx for idx in range(len(sys_pdf))]
+        if os.path.exists(path):
+            os.remove(path)
+
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("CREATE TABLE entries (uid INTEGER PRIMARY KEY, %s)"
+                         % ", ".join("%s INTEGER NOT NULL" % c for c in usr_cols + sys_cols))
+            insert = "INSERT INTO entries VALUES (%s)" % ", ".join(["?"] * (1 + len(usr_cols) + len(sys_cols)))
+            start = 0
+            for usr_block, sys_block in chunks:
+                uids = np.arange(start, start + len(usr_block))[:, None]
+                conn.executemany(insert, np.hstack([uids, usr_block, sys_block]).tolist())
+                start += len(usr_block)
+
+            for c in usr_cols:
+                conn.execute("CREATE INDEX entries_%s ON entries (%s)" % (c, c))
+            # the same order as np.unique(table, axis=0), so both backends sample the same goals
+            conn.execute("CREATE TABLE unique_rows (id INTEGER PRIMARY KEY, %s)" % ", ".join(usr_cols))
+            conn.execute("INSERT INTO unique_rows (%s) SELECT DISTINCT %s FROM entries ORDER BY %s"
+                         % ((", ".join(usr_cols),) * 3))
+            num_unique_rows = conn.execute("SELECT COUNT(*) FROM unique_rows").fetchone()[0]
+
+            meta = {'usr_modalities': json.dumps([len(p) for p in usr_pdf]),
+                    'sys_modalities': json.dumps([len(p) for p in sys_pdf]),
+                    'usr_pdf': json.dumps([p.tolist() for p in usr_pdf]),
+                    'sys_pdf': json.dumps([p.tolist() for p in sys_pdf]),
+                    'num_rows': str(num_rows), 'num_unique_rows': str(num_unique_rows)}
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", sorted(meta.items()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connection(self):
+        """
+        :return: the read only connection of the calling thread. Connections are pooled per thread and opened
+        again in a forked process, since a SQLite connection must not cross a fork.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._connections = {}
+            key = threading.current_thread().ident
+            conn = self._connections.get(key)
+            if conn is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute("PRAGMA query_only = ON")
+                self._connections[key] = conn
+        return conn
+
+    def close(self):
+        """
+        Close every pooled connection of this process.
+        """
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections = {}
+
+    def __getstate__(self):
+        return {'path': self.path, 'cache_bytes': self.query_cache.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state.get('cache_bytes', Database.CACHE_BYTES))
+
+    def _where(self, query):
+        # the same semantics as Database.select_bits: a truthy value q excludes the rows equal to q
+        conds, params = [], []
+        for q, a_id in zip(query, range(self.num_usr_slots)):
+            if q:
+                conds.append("usr_%d != ?" % a_id)
+                params.append(int(q))
+        return (" WHERE " + " AND ".join(conds) if conds else ""), params
+
+    def _value_bits(self, a_id, value):
+        """
+        :return: the packed bitset of the rows whose searchable column a_id is value, the same as
+        Database.indexes[a_id][value]
+        """
+        # query_cache is shared by the threads, so every access holds the lock. The read from the index does not,
+        # and two threads that miss the same key both read it.
+        key = (a_id, value)
+        with self._lock:
+            bits = self.query_cache.get(key)
+        if bits is not None:
+            return bits
+
+        # the UIDs come from the index as one string instead of a Python tuple per row
+        uids = self._connection().execute("SELECT group_concat(uid) FROM entries WHERE usr_%d = ?" % a_id,
+                                          (value,)).fetchone()[0]
+        rows = np.zeros(self.num_rows, dtype=bool)
+        if uids:
+            rows[np.fromstring(uids, dtype=np.int64, sep=',')] = True
+        bits = np.packbits(rows)
+        bits.flags.writeable = False
+        with self._lock:
+            self.query_cache.put(key, bits)
+        return bits
+
+    def select_bits(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the bitset of the rows that satisfy all constrains, see Database.select_bits
+        """
+        valid_bits = self.all_rows.copy()
+        for q, a_id in zip(query, range(self.num_usr_slots)):
+            if q:
+                np.bitwise_and(valid_bits, np.invert(self._value_bits(a_id, int(q))), out=valid_bits)
+                if not valid_bits.any():
+                    break
+        return valid_bits
+
+    def share(self, dirname):
+        """
+        The file is already shared by every process that opens it, so there is nothing to do.
+        """
+        pass
+
+    def sample_unique_row(self, rng=np.random):
+        """
+        :param rng: a numpy RandomState
+        :return: a unique row in the searchable table
+        """
+        return self.sample_unique_rows(1, rng)[0]
+
+    def sample_unique_rows(self, num_samples, rng=np.random):
+        """
+        :param num_samples: the number of rows
+        :param rng: a numpy RandomState
+        :return: 2D array [num_samples, num_usr_slots], each row drawn uniformly from the unique rows
+        """
+        ids = rng.randint(0, self.num_unique_rows, size=num_samples)
+        return self._fetch("unique_rows", self._usr_cols, ids)[:, 1:]
+
+    def lookup(self, uids):
+        """
+        :param uids: the UIDs of some entries
+        :return: 2D array [len(uids), 1+num_sys_slots] of their system entries, in the same order
+        """
+        return self._fetch("entries", self._sys_cols, uids)[:, 1:]
+
+    def _fetch(self, table, cols, ids):
+        # batch the lookups into as few statements as the parameter limit allows. unique_rows counts from 1.
+        ids = np.asarray(ids, dtype=np.int64) + (1 if table == "unique_rows" else 0)
+        rows = {}
+        conn = self._connection()
+        unique_ids = np.unique(ids).tolist()
+        for start in range(0, len(unique_ids), self.MAX_VARIABLES):
+            batch = unique_ids[start:start+self.MAX_VARIABLES]
+            sql = "SELECT rowid, %s FROM %s WHERE rowid IN (%s)" % (cols, table, ", ".join(["?"] * len(batch)))
+            for row in conn.execute(sql, batch):
+                rows[row[0]] = row
+        return np.array([rows[i] for i in ids.tolist()], dtype=np.int64).reshape(len(ids), -1)
+
+    def count(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the number of rows that satisfy all constrains
+        """
+        return int(Database.POPCOUNT[self.select_bits(query)].sum())
+
+    def exists(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: True if any row satisfies all constrains
+        """
+        return bool(self.select_bits(query).any())
+
+    def sample_match(self, query, rng=np.random):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :param rng: a numpy RandomState
+        :return: a uniformly random system entry that satisfies all constrains, or None if there is none
+        """
+        # the UIDs run from 0 to num_rows - 1 in the order of the bits, so the k-th match is found by counting
+        # the bits byte by byte instead of skipping k rows with OFFSET
+        valid_bits = self.select_bits(query)
+        counts = np.cumsum(Database.POPCOUNT[valid_bits], dtype=np.int64)
+        if len(counts) == 0 or counts[-1] == 0:
+            return None
+        k = rng.randint(0, int(counts[-1]))
+        byte = int(np.searchsorted(counts, k, side='right'))
+        before = counts[byte-1] if byte > 0 else 0
+        uid = 8 * byte + int(np.flatnonzero(np.unpackbits(valid_bits[byte:byte+1]))[k - before])
+        row = self._connection().execute("SELECT %s FROM entries WHERE uid = ?" % self._sys_cols, (uid,))
+        return np.array(row.fetchone(), dtype=np.int64)
+
+    def select_index(self, query):
+        """
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :return: the array of the indexes of the rows that satisfy all constrains
+        """
+        return np.flatnonzero(np.unpackbits(self.select_bits(query))[:self.num_rows])
+
+    def select(self, query, return_index=False):
+        """
+        Filter the database entries according the query.
+
+        :param query: 1D [] equal to the number of attributes, None means don't care
+        :param return_index: if return the db index
+        :return return a list system_entries and (optional)index array that satisfy all constrains
+        """
+        where, params = self._where(query)
+        rows = self._connection().execute("SELECT %s FROM entries%s ORDER BY uid" % (self._sys_cols, where), params)
+        entries = np.array(rows.fetchall(), dtype=np.int64).reshape(-1, 1+self.num_sys_slots)
+        if return_index:
+            return entries, entries[:, 0].copy()
+        return entries
+
+    def pprint(self):
+        """
+        print statistics of the database in a beautiful format.
+        """
+        self.logger.info("SQLite DB %s contains %d rows (%d unique ones), with %d attributes"
+                         % (self.path, self.num_rows, self.num_unique_rows, self.num_usr_slots))
+
+
+def open_database(path, kb_dir=None):
+    """
+    :param path: a SqliteDatabase file, a Database snapshot, or the digest of a snapshot in kb_dir
+    :param kb_dir: the folder to look up digests in
+    :return: a SqliteDatabase or a Database
+    """
+    if path.endswith(SqliteDatabase.EXTENSION):
+        return SqliteDatabase(path)
+    return Database.load(path, kb_dir=kb_dir)
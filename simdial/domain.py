@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
-from simdial.database import Database
+from simdial.database import Database, SqliteDatabase, open_database
 import numpy as np
 from simdial.agent.core import BaseSysSlot
+from simdial.config import Config
+import tempfile
+import hashlib
 import logging
+import pickle
+import shutil
+import json
+import os
 
 
 class DomainSpec(object):
@@ -30,12 +37,21 @@ class DomainSpec(object):
                 'name': self.name,
                 'greet': self.greet}
 
+    def digest(self):
+        """
+        :return: the hex SHA-1 of the content of the spec
+        """
+        return hashlib.sha1(json.dumps(self.to_dict(), sort_keys=True).encode('utf-8')).hexdigest()
+
 
 class Slot(object):
     """
     Class for sys/usr slot
+
+    :ivar sid: the integer id of the slot in its Domain. User slots come first, then system slots.
     """
     def __init__(self, name, description, vocabulary):
+        self.sid = None
         self.name = name
         self.description = description
         self.vocabulary = vocabulary
@@ -44,30 +60,39 @@ class Slot(object):
         self.informs = []
         self.yn_questions = {}
 
-    def sample_request(self):
+    def freeze(self):
+        """
+        Turn the vocabulary and the templates into tuples.
+        """
+        self.vocabulary = tuple(self.vocabulary)
+        self.requests = tuple(self.requests)
+        self.informs = tuple(self.informs)
+        self.yn_questions = {k: tuple(v) for k, v in self.yn_questions.items()}
+
+    def sample_request(self, rng=np.random):
         if self.requests:
-            return np.random.choice(self.requests)
+            return rng.choice(self.requests)
         else:
             raise ValueError("Sample from empty request_utt pool")
 
-    def sample_inform(self):
+    def sample_inform(self, rng=np.random):
         if self.informs:
-            return np.random.choice(self.informs)
+            return rng.choice(self.informs)
         else:
             raise ValueError("Sample from empty inform_utt pool")
 
-    def sample_yn_question(self, expect_val):
+    def sample_yn_question(self, expect_val, rng=np.random):
         questions = self.yn_questions.get(expect_val, [])
         if questions:
-            return np.random.choice(questions)
+            return rng.choice(questions)
         else:
             raise ValueError("Sample from empty yn_questions pool")
 
-    def sample_different(self, value):
+    def sample_different(self, value, rng=np.random):
         if value is None:
-            return np.random.randint(0, self.dim)
+            return rng.randint(0, self.dim)
         else:
-            return np.random.choice([None] + [i for i in range(self.dim) if i != value])
+            return rng.choice([None] + [i for i in range(self.dim) if i != value])
 
 
 class Domain(object):
@@ -79,13 +104,23 @@ class Domain(object):
     that contains slot_name, slot_description, dimension
     :ivar usr_slots: a list of slots that users can impose a constrains. Each slot is a dictionary 
     that contains slot_name, slot_description, dimension
+    :ivar slots: every slot indexed by its sid, i.e. usr_slots + sys_slots
+    :ivar usr_slot_map: user slot name -> (slot, index in usr_slots)
+    :ivar sys_slot_map: system slot name -> (slot, index in sys_slots)
+    :cvar COMPILE_FORMAT: the version of the pickles of compile. Bump it when the pickled attributes change.
     """
 
     logger = logging.getLogger(__name__)
+    COMPILE_FORMAT = 1
 
-    def __init__(self, domain_spec):
+    def __init__(self, domain_spec, seed=None, mmap_dir=None, db=None):
         """
         :param domain_spec: an implementation of DomainSpec
+        :param seed: the seed of the DB. The DB is sampled from the global RNG if None.
+        :param mmap_dir: if given, the DB tables are memory mapped files in a new folder under this one, which is
+        removed when the process exits, see Database.close
+        :param db: an existing Database or SqliteDatabase, the path of a snapshot or of a SqliteDatabase file,
+        or the digest of a snapshot in Config.kb_dir. A new DB is sampled if None.
         """
         self.name = domain_spec.name
         self.greet = domain_spec.greet
@@ -93,6 +128,13 @@ class Domain(object):
         self.sys_slots = [Slot("#"+name, desc, vocab) for name, desc, vocab in domain_spec.sys_slots]
         self.sys_slots.insert(0, Slot(BaseSysSlot.DEFAULT, "", [str(i) for i in range(domain_spec.db_size)]))
 
+        # O(1) lookups for the per turn code paths
+        self.slots = self.usr_slots + self.sys_slots
+        for sid, slot in enumerate(self.slots):
+            slot.sid = sid
+        self.usr_slot_map = {s.name: (s, s_id) for s_id, s in enumerate(self.usr_slots)}
+        self.sys_slot_map = {s.name: (s, s_id) for s_id, s in enumerate(self.sys_slots)}
+
         for slot_name, slot_nlg in domain_spec.nlg_spec.items():
             slot_name = "#"+slot_name
             slot = self.get_usr_slot(slot_name) if self.is_usr_slot(slot_name) else self.get_sys_slot(slot_name)
@@ -102,26 +144,96 @@ class Domain(object):
                 slot.yn_questions = slot_nlg.get('yn_question', {})
             else:
                 raise Exception("Fail to align %s nlg spec with the rest of domain" % slot_name)
+        # the slots never change after this point
+        for slot in self.slots:
+            slot.freeze()
         usr_slot_priors = [np.ones(s.dim) for s in self.usr_slots]  # we assume a uniform prior
         # we left out DEFAULT from prior since it'e KEY
         sys_slot_priors = [np.ones(s.dim) for s in self.sys_slots[1:]]
 
-        self.db = Database(usr_slot_priors, sys_slot_priors, num_rows=domain_spec.db_size)
+        if db is None:
+            rng = np.random if seed is None else np.random.RandomState(seed)
+            db = Database(usr_slot_priors, sys_slot_priors, num_rows=domain_spec.db_size, rng=rng,
+                          mmap_dir=mmap_dir)
+        elif not isinstance(db, (Database, SqliteDatabase)):
+            db = open_database(db, kb_dir=Config.kb_dir)
+
+        if db.num_rows != domain_spec.db_size or db.usr_modalities != [s.dim for s in self.usr_slots] \
+                or db.sys_modalities != [s.dim for s in self.sys_slots[1:]]:
+            raise ValueError("The database does not match the slots of %s" % self.name)
+        self.db = db
         self.db.pprint()
 
+    @classmethod
+    def compile(cls, domain_spec, cache_dir, seed=None):
+        """
+        Load the Domain of domain_spec from cache_dir, or build it and save it there. The compiled domain is the
+        pickled Domain itself: its slots with their ids, frozen vocabularies and templates, and a DB whose arrays
+        are kept as shared .npy files next to the pickle (see Database.share), so the pickle is small and every
+        process that loads it maps the same DB. The templates stay tuples of strings, the way the NLGs sample
+        them. The cache key is the content hash of the spec, the seed and COMPILE_FORMAT.
+
+        Any number of processes can compile into the same cache_dir at once. Each one writes its files under a
+        temporary name and renames them into place, so a file that is mapped or loaded is never rewritten.
+
+        :param domain_spec: an implementation of DomainSpec
+        :param cache_dir: the folder of compiled domains
+        :param seed: the seed of the DB. The DB is sampled from the global RNG and not cached if None, since it
+        would not be the same DB the next time.
+        :return: a Domain
+        """
+        if seed is None:
+            cls.logger.warning("No seed for %s, the domain is built without the cache" % domain_spec.name)
+            return cls(domain_spec)
+
+        # the pickle refers to the DB files by path, which must not depend on the working directory
+        cache_dir = os.path.abspath(cache_dir)
+        key = "%s-%s-%s-v%d" % (domain_spec.name, domain_spec.digest(), seed, cls.COMPILE_FORMAT)
+        path = os.path.join(cache_dir, key + ".pkl")
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                domain = pickle.load(f)
+            cls.logger.info("Loaded compiled domain %s" % path)
+            return domain
+
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        domain = cls(domain_spec, seed=seed)
+        db_dir = os.path.join(cache_dir, key)
+        tmp_dir = tempfile.mkdtemp(prefix=key + ".", suffix=".tmp", dir=cache_dir)
+        domain.db.share(tmp_dir)
+        domain.db.shared_dir = db_dir
+        try:
+            os.rename(tmp_dir, db_dir)
+        except OSError:
+            # another process compiled the same DB first. The seed makes it the same DB, and the files mapped
+            # here stay valid after they are removed.
+            if not os.path.isdir(db_dir):
+                raise
+            shutil.rmtree(tmp_dir)
+
+        # write then rename, so an interrupted compile never leaves a partial file
+        fd, tmp_path = tempfile.mkstemp(prefix=key + ".", suffix=".tmp", dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(domain, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        cls.logger.info("Compiled domain %s" % path)
+        return domain
+
     def get_usr_slot(self, slot_name, return_idx=False):
         """
         :param slot_name: the target slot name
         :param return_idx: True/False to return slot index
         :return: slot, (index) or None if it's not user slot
         """
-        for s_id, s in enumerate(self.usr_slots):
-            if s.name == slot_name:
-                if return_idx:
-                    return s, s_id
-                else:
-                    return s
-        return None
+        entry = self.usr_slot_map.get(slot_name)
+        if entry is None:
+            return None
+        return entry if return_idx else entry[0]
 
     def get_sys_slot(self, slot_name, return_idx=False):
         """
@@ -129,17 +241,29 @@ class Domain(object):
         :param return_idx: True/False to return slot index
         :return: slot, (index) or None if it's not system slot
         """
-        for s_id, s in enumerate(self.sys_slots):
-            if s.name == slot_name:
-                if return_idx:
-                    return s, s_id
-                else:
-                    return s
-        return None
+        entry = self.sys_slot_map.get(slot_name)
+        if entry is None:
+            return None
+        return entry if return_idx else entry[0]
 
     def is_usr_slot(self, query_name):
         """
         :param query_name: a slot name
         :return: True if slot_name is user slot, False o/w
         """
-        return query_name in [s.name for s in self.usr_slots]
+        return query_name in self.usr_slot_map
+
+    def get_slot(self, sid):
+        """
+        :param sid: the integer id of a slot
+        :return: the slot
+        """
+        return self.slots[sid]
+
+    def get_slot_id(self, slot_name):
+        """
+        :param slot_name: a user or system slot name
+        :return: the integer id of the slot, or None if there is no such slot
+        """
+        entry = self.usr_slot_map.get(slot_name) or self.sys_slot_map.get(slot_name)
+        return None if entry is None else entry[0].sid
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Simulate the dialogs of a corpus one round at a time, alone or many of them in lockstep for a BatchPolicy.
+"""
+from simdial.agent.user import User
+from simdial.agent.system import System, DialogState
+from simdial.agent.policy import encode_states
+from simdial.channel import ActionChannel, WordChannel
+import logging
+
+
+class Session(object):
+    """
+    One dialog between a new user and a new system, simulated one round at a time. A round is the system turn and,
+    unless the system ends the dialog, the user turn that answers it.
+
+    :ivar dialog: the turns so far
+    :ivar done: True when the dialog is over
+    :ivar reward: the reward of the user in the last round
+    """
+
+    def __init__(self, generator, domain, complexity, seed, index, belief_buffers=None, planner=None):
+        """
+        :param generator: the Generator that gives the language and the random streams
+        :param seed: the corpus seed
+        :param index: the index of the dialog in the corpus
+        :param belief_buffers: the arrays to keep the system beliefs in, see DialogState
+        :param planner: the GoalPlanner of the corpus, or None if the user samples its own goals
+        """
+        sim_rng, nlg_rng = generator.session_rngs(seed, index)
+        self.generator = generator
+        self.domain = domain
+        self.action_channel = ActionChannel(domain, complexity, sim_rng)     # action 等级上的 error Channel
+        self.word_channel = WordChannel(domain, complexity, nlg_rng)         # word 等级上的 channel
+
+        # natural language generators
+        nlg_module = generator.NLG_MODULES[generator.language]
+        self.sys_nlg = nlg_module.SysNlg(domain, complexity, nlg_rng)         # 配置系统nlg
+        self.usr_nlg = nlg_module.UserNlg(domain, complexity, nlg_rng)        # 配置用户nlg
+
+        goal = None if planner is None else planner.goal(index)
+        self.usr = User(domain, complexity, sim_rng, goal)                    # 初始化用户模拟器
+        self.sys = System(domain, complexity, belief_buffers, generator.policy_mode)   # 初始化概率 dm
+
+        self.fields = generator.fields
+        self.noisy_usr_as = []
+        self.conf = 1.0
+        self.dialog = []
+        self.done = False
+        self.reward = 0.0
+
+    def listen(self):
+        """
+        Update the system state with the last user turn.
+        """
+        self.sys.state_update(self.noisy_usr_as, self.conf)
+
+    def respond(self):
+        """
+        Finish the round started by listen.
+        """
+        # 系统reward 系统结束标志 系统动作 系统状态
+        self.finish(*self.sys.respond(summarize='state' in self.fields))
+
+    def begin_respond(self):
+        """
+        Start the system turn of the round started by listen, to make its decisions with take.
+        """
+        self.sys.begin_response(summarize='state' in self.fields)
+
+    def take(self, action):
+        """
+        Give the next decision of the system, and finish the round if it ends the system turn.
+
+        :param action: an Action, a list of Action or None
+        :return: True if the round is finished
+        """
+        result = self.sys.take(action)
+        if result is None:
+            return False
+        self.finish(*result)
+        return True
+
+    def finish(self, sys_r, sys_t, sys_as, sys_s):
+        """
+        Output the system turn, and simulate the user turn that answers it.
+        """
+        fields = self.fields
+        self.reward = 0.0
+        sys_utt, sys_str_as = None, None
+        if 'utt' in fields:
+            sys_utt, sys_str_as = self.sys_nlg.generate_sent(sys_as, domain=self.domain,
+                                                             lexicalize='actions' in fields)   # nlg
+        elif 'actions' in fields:
+            sys_str_as = self.sys_nlg.lexicalize(sys_as)
+        # 打包系统信息封装到dialog中
+        self.dialog.append(self.generator.pack_msg("SYS", sys_utt, **self._projected(
+            actions=sys_str_as, domain=self.domain.name, state=sys_s)))
+
+        if sys_t:
+            self.done = True
+            return
+
+        self.reward, usr_t, usr_as = self.usr.step(sys_as)    #用户 reward 用户是否终止 用户动作列表
+
+        # 通过各个等级的error channel 添加噪声
+        # passing through noise, nlg and noise!
+        self.noisy_usr_as, self.conf = self.action_channel.transmit2sys(usr_as)
+        noisy_usr_utt = None
+        if 'utt' in fields:
+            usr_utt = self.usr_nlg.generate_sent(self.noisy_usr_as)               # nlg 生成用户语句
+            noisy_usr_utt = self.word_channel.transmit2sys(usr_utt)
+
+        # 打包用户信息封装到dialog中
+        self.dialog.append(self.generator.pack_msg("USR", noisy_usr_utt, **self._projected(
+            actions=self.noisy_usr_as, conf=self.conf, domain=self.domain.name)))
+
+    def _projected(self, **kwargs):
+        """
+        :return: kwargs without the optional fields that are not output
+        """
+        return {k: v for k, v in kwargs.items() if k in self.fields or k not in self.generator.FIELDS}
+
+    def step(self):
+        """
+        Simulate one round.
+        """
+        self.listen()
+        self.respond()
+
+
+class BatchEngine(object):
+    """
+    Simulate up to batch_size dialogs of a corpus at the same time for a BatchPolicy that replaces the policies of
+    the systems. Every step advances all the active dialogs by one round, and a finished dialog is retired and
+    replaced by the next dialog of the corpus. The decisions that are pending in all the active dialogs are gathered
+    and encoded from the struct-of-arrays of their beliefs [batch_size, num_usr_slots, width], and the policy makes
+    them in one call, until every system turn ends. The users, the noises and the NLGs run per dialog on their own
+    random streams, as in Generator.gen_session.
+
+    The rule based policy does not need the engine: most of a round is spent in the users, the noises and the NLGs,
+    so simulating its dialogs in lockstep is not faster than one at a time.
+
+    :ivar batch_size: the max number of active dialogs
+    :ivar policy: the BatchPolicy
+    :cvar BATCH_SIZE: the default batch_size
+    """
+    logger = logging.getLogger(__name__)
+    BATCH_SIZE = 256
+
+    def __init__(self, generator, domain, complexity, policy, batch_size=BATCH_SIZE):
+        """
+        :param generator: the Generator that gives the language and the random streams
+        :param policy: a BatchPolicy
+        """
+        self.generator = generator
+        self.domain = domain
+        self.complexity = complexity
+        self.batch_size = batch_size
+        self.policy = policy
+
+    def iter_shard(self, start, stop, seed):
+        """
+        Generate the dialogs with index in [start, stop).
+
+        :param seed: the corpus seed
+        :return: an iterator over dialogs, in order
+        """
+        scores, observed, max_idx = DialogState.new_belief_buffers(self.domain, (self.batch_size,))
+        planner = self.generator.goal_planner(self.domain, self.complexity, seed)
+        sessions = [None] * self.batch_size         # row of the beliefs -> (index, Session)
+        free_rows = list(range(self.batch_size))[::-1]
+        next_index = start
+        finished = {}                               # index -> dialog, until every earlier dialog is yielded
+        next_yield = start
+
+        while next_yield < stop:
+            while free_rows and next_index < stop:
+                row = free_rows.pop()
+                scores[row] = 0.0
+                observed[row] = False
+                max_idx[row] = -1
+                sessions[row] = (next_index, Session(self.generator, self.domain, self.complexity, seed, next_index,
+                                                     (scores[row], observed[row], max_idx[row]), planner))
+                next_index += 1
+
+            active = [row for row in range(self.batch_size) if sessions[row] is not None]
+            for row in active:
+                sessions[row][1].listen()
+            self.decide([sessions[row][1] for row in active], (scores[active], observed[active], max_idx[active]))
+
+            for row in active:
+                index, session = sessions[row]
+                if session.done:
+                    finished[index] = session.dialog
+                    sessions[row] = None
+                    free_rows.append(row)
+
+            while next_yield in finished:
+                yield finished.pop(next_yield)
+                next_yield += 1
+
+    def decide(self, sessions, belief_buffers):
+        """
+        Make every decision of the system turns of sessions with the policy, and finish their rounds.
+
+        :param sessions: the sessions after listen
+        :param belief_buffers: the (scores, observed, max_idx) beliefs of sessions, at the start of the turn
+        """
+        for session in sessions:
+            session.begin_respond()
+        pending = list(range(len(sessions)))
+        while pending:
+            states = [sessions[i].sys.state for i in pending]
+            decisions = self.policy.act(states, encode_states(states, belief_buffers))
+            pending = [i for i, action in zip(pending, decisions) if not sessions[i].take(action)]
+            # the decisions change the beliefs, so the next ones are encoded from the states
+            belief_buffers = None
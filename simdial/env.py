@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Gym style environments to train a system policy against the simulated user and the noise channels.
+
+An observation is the system DialogState encoded by encode_states, i.e. a dict of arrays, plus the action_mask of
+the codes of DiscreteActions that are valid in it. An action is a decision as in BatchPolicy, or the code of a
+decision of DiscreteActions. A code that is not valid raises ValueError before anything is stepped. A step makes
+one decision. It advances the dialog by one round when the decision ends the system turn, and its reward is then
+the reward of the user turn that answers it (see User.step). The dialog of an environment only depends on the seed
+and the dialog index, the same as the dialogs of Generator.
+
+No gym is needed. The classes follow its reset/step interface, and the vectorized ones reset a finished dialog to
+the next one by themselves.
+"""
+from simdial.generator import Generator
+from simdial.engine import Session
+from simdial.agent.system import DialogState
+from simdial.agent.policy import encode_states, DiscreteActions
+from multiprocessing.sharedctypes import RawArray
+import multiprocessing
+import numpy as np
+import numbers
+import logging
+import ctypes
+
+
+class DialogEnv(object):
+    """
+    One dialog at a time. The observations have no batch dimension.
+
+    :ivar index: the index of the current dialog
+    :ivar session: the Session of the current dialog
+    :ivar actions: the DiscreteActions of the domain
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, domain, complexity, seed=0, language='en', fields=(), start=0, stride=1, belief_buffers=None):
+        """
+        :param domain: a Domain
+        :param complexity: a Complexity
+        :param seed: the corpus seed of the dialogs
+        :param fields: the turn fields of the dialogs in the infos, see Generator. Every field costs time.
+        :param start: the index of the first dialog
+        :param stride: the difference between the indexes of two dialogs in a row
+        :param belief_buffers: the arrays to keep the system beliefs in, see DialogState. New ones every dialog if
+        None.
+        """
+        self.generator = Generator(language, fields=fields)
+        self.domain = domain
+        self.complexity = complexity
+        self.seed = seed
+        self.stride = stride
+        self.belief_buffers = belief_buffers
+        self.index = start - stride
+        self.session = None
+        self.actions = DiscreteActions.for_state(DialogState(domain))
+
+    @property
+    def state(self):
+        """
+        :return: the system DialogState of the current dialog
+        """
+        return self.session.sys.state
+
+    def reset(self):
+        """
+        Start the next dialog.
+
+        :return: the first observation
+        """
+        self.start_next()
+        return self.observe()
+
+    def step(self, action):
+        """
+        :param action: a decision, or the code of one
+        :return: observation, reward, done, info. info has the dialog index, and the dialog when it is done.
+        """
+        reward, done, info = self.take(action)
+        return self.observe(), reward, done, info
+
+    def observe(self):
+        features = encode_states([self.state])
+        features['action_mask'] = self.actions.masks([self.state])
+        return {k: v[0] for k, v in features.items()}
+
+    def start_next(self):
+        self.index += self.stride
+        if self.belief_buffers is not None:
+            scores, observed, max_idx = self.belief_buffers
+            scores[...] = 0.0
+            observed[...] = False
+            max_idx[...] = -1
+        self.session = Session(self.generator, self.domain, self.complexity, self.seed, self.index,
+                               self.belief_buffers)
+        self.begin_turn()
+
+    def begin_turn(self):
+        self.session.listen()
+        self.session.begin_respond()
+
+    def decode(self, action):
+        """
+        :param action: a decision, or the code of one
+        :return: the decision. ValueError if the dialog is over or the code is not valid, see DiscreteActions.mask.
+        """
+        if self.session.done:
+            raise ValueError("Dialog %d is over, reset the environment" % self.index)
+        if isinstance(action, numbers.Integral):
+            return self.actions.decode(action, self.state)
+        return action
+
+    def take(self, action):
+        """
+        Make a decision without an observation.
+
+        :return: reward, done, info
+        """
+        session = self.session
+        action = self.decode(action)
+
+        reward = 0.0
+        if session.take(action):
+            reward = session.reward
+            if not session.done:
+                self.begin_turn()
+        info = {'index': self.index}
+        if session.done:
+            info['dialog'] = session.dialog
+        return reward, session.done, info
+
+
+class VecDialogEnv(object):
+    """
+    num_envs dialogs in lockstep in this process. Their system beliefs are rows of one struct-of-arrays, like the
+    ones of BatchEngine, and the observations of all of them are encoded in one call. A dialog that is done is
+    replaced by the next one of its environment, so the observation of a done environment is the first one of its
+    next dialog. Environment k plays the dialogs offset + k, offset + k + stride, ...
+
+    The belief arrays of the observations are the live beliefs. Copy them to keep them after the next step.
+
+    :ivar envs: the DialogEnv of every row
+    :ivar num_envs: the number of environments
+    """
+
+    def __init__(self, domain, complexity, num_envs, seed=0, language='en', fields=(), offset=0, stride=None):
+        """
+        :param stride: num_envs if None
+        """
+        stride = num_envs if stride is None else stride
+        self.num_envs = num_envs
+        self.belief_buffers = DialogState.new_belief_buffers(domain, (num_envs,))
+        scores, observed, max_idx = self.belief_buffers
+        self.envs = [DialogEnv(domain, complexity, seed, language, fields, offset + k, stride,
+                               (scores[k], observed[k], max_idx[k]))
+                     for k in range(num_envs)]
+
+    @property
+    def actions(self):
+        return self.envs[0].actions
+
+    def reset(self):
+        """
+        :return: the observations of the first dialogs
+        """
+        for env in self.envs:
+            env.start_next()
+        return self.observe()
+
+    def step(self, actions):
+        """
+        :param actions: one decision, or the code of one, per environment
+        :return: observations, rewards : float array, dones : bool array, infos
+        """
+        # decode every action first, so an invalid one leaves every dialog as it was
+        actions = [env.decode(action) for env, action in zip(self.envs, actions)]
+        rewards = np.zeros(self.num_envs)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        infos = []
+        for k, (env, action) in enumerate(zip(self.envs, actions)):
+            rewards[k], dones[k], info = env.take(action)
+            if dones[k]:
+                env.start_next()
+            infos.append(info)
+        return self.observe(), rewards, dones, infos
+
+    def observe(self):
+        states = [env.state for env in self.envs]
+        features = encode_states(states, self.belief_buffers)
+        # keep the max that the encoding computed, so the next decisions do not compute it again
+        self.belief_buffers[2][...] = features['max_idx']
+        features['action_mask'] = self.actions.masks(states)
+        return features
+
+
+def _env_worker(conn, domain, complexity, seed, language, fields, lo, hi, num_envs, buffers):
+    env = VecDialogEnv(domain, complexity, hi - lo, seed, language, fields, offset=lo, stride=num_envs)
+    observation, rewards, dones = buffers
+    observation = {k: v[lo:hi] for k, v in observation.items()}
+    rewards, dones = rewards[lo:hi], dones[lo:hi]
+    while True:
+        cmd, data = conn.recv()
+        try:
+            if cmd == 'reset':
+                features, infos = env.reset(), None
+            elif cmd == 'step':
+                features, rewards[...], dones[...], infos = env.step(data)
+            else:
+                break
+            for k, v in features.items():
+                observation[k][...] = v
+            conn.send(infos)
+        except Exception as e:
+            conn.send(e)
+    conn.close()
+
+
+class SubprocVecDialogEnv(object):
+    """
+    num_envs dialogs in lockstep, split into num_workers processes that each step a VecDialogEnv. The observations,
+    rewards and dones are written by the workers into shared memory, so only the actions and the infos are sent
+    between the processes. The dialogs are the same as the ones of a VecDialogEnv of num_envs.
+
+    The arrays that step returns are overwritten by the next step. Copy them to keep them.
+
+    :ivar observation: the shared observation arrays, see encode_states, and the action_mask
+    :ivar rewards: the shared rewards : float array [num_envs]
+    :ivar dones: the shared dones : bool array [num_envs]
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, domain, complexity, num_envs, num_workers, seed=0, language='en', fields=()):
+        self.num_envs = num_envs
+        self.actions = DiscreteActions.for_state(DialogState(domain))
+        sample = encode_states([DialogState(domain)])
+        sample['action_mask'] = self.actions.masks([DialogState(domain)])
+
+        def shared(shape, dtype):
+            raw = RawArray(ctypes.c_char, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+        self.observation = {k: shared((num_envs,) + v.shape[1:], v.dtype) for k, v in sample.items()}
+        self.rewards = shared((num_envs,), np.float64)
+        self.dones = shared((num_envs,), bool)
+
+        self.bounds = [b for b in Generator.split_shards(num_envs, num_workers) if b[1] > b[0]]
+        self.conns = []
+        self.processes = []
+        for lo, hi in self.bounds:
+            conn, child_conn = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_env_worker,
+                                        args=(child_conn, domain, complexity, seed, language, fields, lo, hi,
+                                              num_envs, (self.observation, self.rewards, self.dones)))
+            p.daemon = True
+            p.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.processes.append(p)
+
+    def _gather(self):
+        # read every worker before raising, so no answer is left in a pipe to be read by the next command
+        results = [conn.recv() for conn in self.conns]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def reset(self):
+        """
+        :return: the observations of the first dialogs
+        """
+        for conn in self.conns:
+            conn.send(('reset', None))
+        self._gather()
+        return self.observation
+
+    def step(self, actions):
+        """
+        :param actions: one decision, or the code of one, per environment
+        :return: observations, rewards, dones, infos
+        """
+        # check the codes against the last observation before any worker steps
+        mask = self.observation['action_mask']
+        for k, action in enumerate(actions):
+            if isinstance(action, numbers.Integral) and not (0 <= action < mask.shape[1] and mask[k, action]):
+                raise ValueError("Action code %s is not valid in environment %d" % (action, k))
+        for conn, (lo, hi) in zip(self.conns, self.bounds):
+            conn.send(('step', list(actions[lo:hi])))
+        infos = []
+        for worker_infos in self._gather():
+            infos.extend(worker_infos)
+        return self.observation, self.rewards, self.dones, infos
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+            conn.close()
+        for p in self.processes:
+            p.join()
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 # author: Tiancheng Zhao
 
-from simdial.agent.user import User
+from simdial.agent.core import Action, SystemAct
 from simdial.agent.system import System
-from simdial.channel import ActionChannel, WordChannel
-#from simdial.agent.nlg import SysNlg, UserNlg
-from simdial.agent.nlg_cn import SysNlg, UserNlg
+from simdial.agent.user import GoalPlanner
+from simdial.agent import nlg, nlg_cn
+from simdial.engine import Session, BatchEngine
 from simdial.complexity import Complexity
 from simdial.domain import Domain
 import progressbar
@@ -14,6 +14,25 @@ import numpy as np
 import sys
 import os
 import re
+import multiprocessing
+import logging
+import shutil
+import pickle
+from collections import OrderedDict
+
+# per process state of the worker pool in Generator.gen
+_worker = {}
+
+
+def _init_worker(generator, domain, complexity):
+    _worker['args'] = (generator, domain, complexity)
+
+
+def _gen_shard(shard):
+    generator, domain, complexity = _worker['args']
+    start, stop, seed = shard
+    return generator.gen_shard(domain, complexity, start, stop, seed)
+
 
 class Generator(object):
     """
@@ -26,7 +45,57 @@ class Generator(object):
 
     # 需要输入领域定义字典和 复杂度配置字典
     The required input is a domain specification dictionary + a configuration dict.
+
+    :cvar NLG_MODULES: language -> the module that contains its SysNlg and UserNlg
+    :cvar SHARDS_PER_WORKER: the number of shards each worker process gets in multi-process mode
+    :cvar MAX_SHARD_SIZE: the max number of dialogs in one shard
+    :cvar SIM_STREAM: the id of the random stream of the user and the action channel
+    :cvar NLG_STREAM: the id of the random stream of the NLGs and the word channel
+    :cvar FIELDS: the optional fields of a turn. Every turn also has speaker and domain, and a USR turn has conf.
     """
+    logger = logging.getLogger(__name__)
+    NLG_MODULES = {'en': nlg, 'cn': nlg_cn}
+    SHARDS_PER_WORKER = 4
+    MAX_SHARD_SIZE = 1000
+    SIM_STREAM = 0
+    NLG_STREAM = 1
+    FIELDS = ('utt', 'actions', 'state')
+
+    def __init__(self, language='cn', batch_size=None, fields=FIELDS, policy_mode=System.RULES,
+                 batch_policy=None, goal_block=None):
+        """
+        :param language: the language of the NLG templates, a key of NLG_MODULES
+        :param batch_size: the max number of dialogs whose decisions batch_policy makes in one call,
+        BatchEngine.BATCH_SIZE if None. It has no effect without batch_policy, and a warning is logged if it is
+        given alone.
+        :param fields: the optional turn fields to output, a subset of FIELDS, e.g. ('utt',) or ('actions',). The
+        fields that are left out are never computed: without utt there is no NLG and no word channel, without
+        actions the system actions are not lexicalized, and without state the system state is not summarized.
+        The other fields are the same as in the full corpus.
+        :param policy_mode: how the systems evaluate their policy, see System. The corpus is the same in every mode.
+        :param batch_policy: a BatchPolicy that makes the system decisions instead of the rule based policy. The
+        dialogs of each process are then simulated in lockstep by a BatchEngine, and the policy decides for up to
+        batch_size of them per call. It is pickled to the worker processes. The corpus is the same for any
+        batch_size.
+        :param goal_block: plan the user goals of every goal_block dialogs at once with a GoalPlanner, instead of
+        each user sampling its own. The corpus is then a different one, but it is still the same for any number of
+        workers. None lets the users sample their goals.
+        """
+        if language not in self.NLG_MODULES:
+            raise ValueError("Unknown language %s" % language)
+        unknown = set(fields) - set(self.FIELDS)
+        if unknown:
+            raise ValueError("Unknown fields %s" % ", ".join(sorted(unknown)))
+        self.language = language
+        if batch_size is None:
+            batch_size = BatchEngine.BATCH_SIZE
+        elif batch_policy is None:
+            self.logger.warning("batch_size %d has no effect without a batch_policy" % batch_size)
+        self.batch_size = batch_size
+        self.fields = frozenset(fields)
+        self.policy_mode = policy_mode
+        self.batch_policy = batch_policy
+        self.goal_block = goal_block
 
     @staticmethod
     def pack_msg(speaker, utt, **kwargs):
@@ -35,7 +104,8 @@ class Generator(object):
         '''
         resp = {k: v for k, v in kwargs.items()}
         resp["speaker"] = speaker
-        resp["utt"] = utt
+        if utt is not None:
+            resp["utt"] = utt
         return resp
 
     @staticmethod
@@ -50,12 +120,12 @@ class Generator(object):
 
         if in_json:
             combo = {'dialogs': dialogs, 'meta': domain_spec.to_dict()}
-            json.dump(combo, f, indent=2)
+            json.dump(combo, f, indent=2, default=Action.json_default)
         else:
             for idx, d in enumerate(dialogs):
                 f.write("## DIALOG %d ##\n" % idx)
                 for turn in d:
-                    speaker, utt, actions = turn["speaker"], turn["utt"], turn["actions"]
+                    speaker, utt, actions = turn["speaker"], turn.get("utt"), turn.get("actions", [])
                     if utt:
                         str_actions = utt
                     else:
@@ -68,102 +138,387 @@ class Generator(object):
         if output_file is not None:
             f.close()
 
+    @staticmethod
+    def pprint_stream(dialogs, domain_spec, output_file=None):
+        """
+        Write the dialogs as JSON lines while they are generated. The first line is {"meta": ...} and each
+        following line is {"dialog": [...]}.
+
+        :param dialogs: an iterable of dialogs, e.g. from iter_gen
+        :param output_file: None if print to STDOUT. Otherwise write the file in the path
+        :return: the number of dialogs written
+        """
+        f = sys.stdout if output_file is None else open(output_file, "wb")
+
+        f.write(json.dumps({'meta': domain_spec.to_dict()}) + "\n")
+        cnt = 0
+        for d in dialogs:
+            f.write(json.dumps({'dialog': d}, default=Action.json_default) + "\n")
+            cnt += 1
+
+        if output_file is not None:
+            f.close()
+        return cnt
+
+    @staticmethod
+    def read_stream(input_file):
+        """
+        Read a file written by pprint_stream.
+
+        :param input_file: the path to a JSON lines corpus
+        :return: the meta dict, an iterator over dialogs
+        """
+        f = open(input_file, "rb")
+        meta = json.loads(f.readline())['meta']
+
+        def dialogs():
+            with f:
+                for line in f:
+                    yield json.loads(line)['dialog']
+        return meta, dialogs()
+
     @staticmethod
     def print_stats(dialogs):
         """
         Print some basic stats of the dialog.
 
-        :param dialogs: A list of dialogs generated.
+        :param dialogs: An iterable of dialogs generated. It is read only once.
         """
-        print("%d dialogs" % len(dialogs))
-        all_lens = [len(d) for d in dialogs]
-        print("Avg len {} Max Len {}".format(np.mean(all_lens), np.max(all_lens)))
-
+        all_lens = []
         total_cnt = 0.
         kb_cnt = 0.
         ratio = []
+        has_queries = True
         for d in dialogs:
+            all_lens.append(len(d))
             local_cnt = 0.
             for t in d:
                 total_cnt +=1
-                if 'QUERY' in t['utt']:
+                is_query = Generator.is_query(t)
+                if is_query is None:
+                    has_queries = False
+                elif is_query:
                     kb_cnt += 1
                     local_cnt += 1
             ratio.append(local_cnt/len(d))
-        print(kb_cnt/total_cnt)
-        print(np.mean(ratio))
 
-    def gen(self, domain, complexity, num_sess=1):
+        print("%d dialogs" % len(all_lens))
+        print("Avg len {} Max Len {}".format(np.mean(all_lens), np.max(all_lens)))
+        if has_queries:
+            print(kb_cnt/total_cnt)
+            print(np.mean(ratio))
+        else:
+            print("KB query ratio unavailable: the turns have neither utt nor actions")
+
+    @staticmethod
+    def is_query(turn):
         """
-        Generate synthetic dialogs in the given domain.
+        :param turn: a turn of a generated or a loaded dialog
+        :return: True if the turn queries the database, None if the turn has neither utt nor actions to tell
+        """
+        if 'utt' in turn:
+            return 'QUERY' in turn['utt']
+        if 'actions' not in turn:
+            return None
+        for a in turn['actions']:
+            act = a.act if isinstance(a, Action) else a['act']
+            if act == SystemAct.QUERY:
+                return True
+        return False
+
+    @staticmethod
+    def split_shards(num_sess, num_shards):
+        """
+        Split the session indexes into contiguous shards.
+
+        :param num_sess: the number of dialogs
+        :param num_shards: the number of shards
+        :return: a list of (start, stop) index ranges, in order
+        """
+        num_shards = max(1, min(num_shards, num_sess))
+        bounds = np.linspace(0, num_sess, num_shards + 1).astype(int)
+        return [(bounds[i], bounds[i+1]) for i in range(num_shards)]
+
+    @classmethod
+    def session_rngs(cls, seed, index):
+        """
+        The random streams of one dialog. They only depend on the corpus seed and the dialog index.
+
+        :return: a RandomState for the user and the action channel, a RandomState for the NLGs and the word channel
+        """
+        return (np.random.RandomState([seed, index, cls.SIM_STREAM]),
+                np.random.RandomState([seed, index, cls.NLG_STREAM]))
+
+    def goal_planner(self, domain, complexity, seed):
+        """
+        :param seed: the corpus seed
+        :return: the GoalPlanner of the corpus, or None if goal_block is None
+        """
+        if self.goal_block is None:
+            return None
+        return GoalPlanner(domain, complexity, seed, self.goal_block)
+
+    def gen_session(self, domain, complexity, seed, index, planner=None):
+        """
+        Simulate one dialog between a new user and a new system. Any dialog of a corpus can be regenerated
+        on its own from the corpus seed and its index.
+
+        :param seed: the corpus seed
+        :param index: the index of the dialog in the corpus
+        :param planner: the GoalPlanner to reuse for the dialogs of a corpus. A new one is made if needed.
+        :return: a dialog as a list of turns
+        """
+        if planner is None:
+            planner = self.goal_planner(domain, complexity, seed)
+        session = Session(self, domain, complexity, seed, index, planner=planner)
+        while not session.done:
+            session.step()
+        return session.dialog
+
+    def iter_shard(self, domain, complexity, start, stop, seed):
+        """
+        Generate the dialogs with index in [start, stop) one at a time. Every dialog has its own random streams
+        derived from (seed, index), so a dialog does not depend on which shard or process generated it.
+
+        :return: an iterator over dialogs
+        """
+        if self.batch_policy is not None:
+            engine = BatchEngine(self, domain, complexity, self.batch_policy, self.batch_size)
+            for dialog in engine.iter_shard(start, stop, seed):
+                yield dialog
+            return
+        planner = self.goal_planner(domain, complexity, seed)
+        for i in range(start, stop):
+            yield self.gen_session(domain, complexity, seed, i, planner)
+
+    def gen_shard(self, domain, complexity, start, stop, seed):
+        """
+        :return: a list of the dialogs with index in [start, stop)
+        """
+        return list(self.iter_shard(domain, complexity, start, stop, seed))
+
+    def iter_gen(self, domain, complexity, num_sess=1, num_workers=1, seed=None, start=0):
+        """
+        Generate synthetic dialogs in the given domain, yielding each dialog as soon as it is done.
 
         :param domain: a domain specification dictionary
         :param complexity: an implmenetaiton of Complexity
         :param num_sess: how dialogs to generate
-        :return: a list of dialogs. Each dialog is a list of turns.
+        :param num_workers: the number of processes. The corpus is the same for any number of workers.
+        :param seed: the corpus seed. Drawn from the global RNG if None.
+        :param start: skip the dialogs before this index, e.g. to continue a corpus
+        :return: an iterator over dialogs, in order. Each dialog is a list of turns.
         """
-        dialogs = []
-        action_channel = ActionChannel(domain, complexity)      # action 等级上的 error Channel
-        word_channel = WordChannel(domain, complexity)          # word 等级上的 channel
-
-        # natural language generators
-        sys_nlg = SysNlg(domain, complexity)                    # 配置系统nlg
-        usr_nlg = UserNlg(domain, complexity)                   # 配置用户nlg
+        if seed is None:
+            seed = np.random.randint(0, 2**31-1)
 
         bar = progressbar.ProgressBar(num_sess)
-        for i in range(num_sess):
-            bar.update(i)
-            usr = User(domain, complexity)                      # 初始化用户模拟器
-            sys = System(domain, complexity)                    # 初始化概率 dm
+        if num_workers <= 1:
+            for i, dialog in enumerate(self.iter_shard(domain, complexity, start, num_sess, seed), start):
+                bar.update(i)
+                yield dialog
+            return
 
-            # begin conversation
-            noisy_usr_as = []
-            dialog = []
-            conf = 1.0
-            while True:
-                # make a decision
-                sys_r, sys_t, sys_as, sys_s = sys.step(noisy_usr_as, conf)       # 系统reward 系统结束标志 系统动作 系统状态
-                sys_utt, sys_str_as = sys_nlg.generate_sent(sys_as, domain=domain)   # nlg
-                # 打包系统信息封装到dialog中
-                dialog.append(self.pack_msg("SYS", sys_utt, actions=sys_str_as, domain=domain.name, state=sys_s))
+        # a few shards per worker to balance the load, and no shard larger than MAX_SHARD_SIZE so that only a
+        # bounded number of dialogs are held in memory. Results are merged in shard order.
+        num_left = num_sess - start
+        num_shards = max(num_workers * self.SHARDS_PER_WORKER, -(-num_left // self.MAX_SHARD_SIZE))
+        shards = [(start+b, start+e) for b, e in self.split_shards(num_left, num_shards)]
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self, domain, complexity))
+        try:
+            cnt = start
+            for shard in pool.imap(_gen_shard, [(b, e, seed) for b, e in shards]):
+                for dialog in shard:
+                    yield dialog
+                cnt += len(shard)
+                bar.update(cnt)
+        finally:
+            pool.terminate()
+            pool.join()
 
-                if sys_t:
-                    break
+    def gen(self, domain, complexity, num_sess=1, num_workers=1, seed=None):
+        """
+        Generate synthetic dialogs in the given domain.
 
-                usr_r, usr_t, usr_as = usr.step(sys_as)    #用户 reward 用户是否终止 用户动作列表
+        :param domain: a domain specification dictionary
+        :param complexity: an implmenetaiton of Complexity
+        :param num_sess: how dialogs to generate
+        :param num_workers: the number of processes. The corpus is the same for any number of workers.
+        :param seed: the corpus seed. Drawn from the global RNG if None.
+        :return: a list of dialogs. Each dialog is a list of turns.
+        """
+        return list(self.iter_gen(domain, complexity, num_sess=num_sess, num_workers=num_workers, seed=seed))
 
-                # 通过各个等级的error channel 添加噪声
-                # passing through noise, nlg and noise!
-                noisy_usr_as, conf = action_channel.transmit2sys(usr_as)
-                usr_utt = usr_nlg.generate_sent(noisy_usr_as)               # nlg 生成用户语句
-                noisy_usr_utt = word_channel.transmit2sys(usr_utt)
+    def gen_checkpointed(self, checkpoint, domain, complexity, size, chunk_size, num_workers=1, seed=None):
+        """
+        Generate a corpus and commit every chunk_size dialogs to the checkpoint. If the checkpoint already has
+        committed dialogs, continue after them with the domain and seed saved in the checkpoint, which gives the
+        same corpus as an uninterrupted run.
 
-                # 打包用户信息封装到dialog中
-                dialog.append(self.pack_msg("USR", noisy_usr_utt, actions=noisy_usr_as, conf=conf, domain=domain.name))
+        :param checkpoint: a Checkpoint
+        :param domain: the domain to use if the checkpoint is new
+        :param seed: the corpus seed to use if the checkpoint is new. Drawn from the global RNG if None.
+        :return: the checkpoint with the complete corpus
+        """
+        if checkpoint.exists():
+            domain, seed, num_done = checkpoint.load(size)
+            self.logger.info("Resume %s from dialog %d" % (checkpoint.path, num_done))
+        else:
+            if seed is None:
+                seed = np.random.randint(0, 2**31-1)
+            checkpoint.create(domain, seed, size)
+            num_done = 0
 
-            dialogs.append(dialog)
+        chunk = []
+        for dialog in self.iter_gen(domain, complexity, num_sess=size, num_workers=num_workers, seed=seed,
+                                    start=num_done):
+            chunk.append(dialog)
+            if len(chunk) == chunk_size:
+                checkpoint.commit(chunk)
+                chunk = []
+        if chunk:
+            checkpoint.commit(chunk)
+        return checkpoint
 
-        return dialogs
+    def gen_corpus(self, name, domain_spec, complexity_spec, size, num_workers=1, seed=None, stream=False,
+                   domain=None, checkpoint_every=None, resume=False, domain_cache=None):
+        """
+        Generate a corpus and write it into the folder name.
 
-    def gen_corpus(self, name, domain_spec, complexity_spec, size):
+        :param stream: write dialogs as JSON lines while they are generated instead of one JSON file at the end
+        :param domain: a Domain already built from domain_spec. A new one is built if None.
+        :param checkpoint_every: commit the dialogs to a checkpoint next to the output every this many dialogs
+        :param resume: continue from the checkpoint of an earlier run if there is one
+        :param domain_cache: a folder of compiled domains to load the domain from instead of building it. The DB of
+        a compiled domain is sampled with seed, and it is not cached if seed is None.
+        """
         if not os.path.exists(name):
             os.mkdir(name)
 
-        # create meta specifications
-        domain = Domain(domain_spec)
-        complex = Complexity(complexity_spec)
-
-        # generate the corpus conditioned on domain & complexity
-        corpus = self.gen(domain, complex, num_sess=size)
-
         # txt_file = "{}-{}-{}.{}".format(domain_spec.name,
         #                                complexity_spec.__name__,
         #                                size, 'txt')
 
         json_file = "{}-{}-{}.{}".format(domain_spec.name,
                                          complexity_spec.__name__,
-                                         size, 'json')
-
+                                         size, 'jsonl' if stream else 'json')
         json_file = os.path.join(name, json_file)
-        self.pprint(corpus, True, domain_spec, json_file)
-        self.print_stats(corpus)
+
+        checkpoint = None
+        if checkpoint_every:
+            checkpoint = Checkpoint(json_file + ".ckpt")
+            if not resume:
+                checkpoint.remove()
+
+        # create meta specifications
+        if domain is None and (checkpoint is None or not checkpoint.exists()):
+            domain = Domain(domain_spec) if domain_cache is None else Domain.compile(domain_spec, domain_cache,
+                                                                                     seed=seed)
+        complex = Complexity(complexity_spec)
+
+        # generate the corpus conditioned on domain & complexity
+        if checkpoint is not None:
+            self.gen_checkpointed(checkpoint, domain, complex, size, checkpoint_every,
+                                  num_workers=num_workers, seed=seed)
+            corpus = checkpoint.iter_dialogs()
+        elif stream:
+            corpus = self.iter_gen(domain, complex, num_sess=size, num_workers=num_workers, seed=seed)
+        else:
+            corpus = self.gen(domain, complex, num_sess=size, num_workers=num_workers, seed=seed)
+
+        if stream:
+            self.pprint_stream(corpus, domain_spec, json_file)
+            self.print_stats(self.read_stream(json_file)[1])
+        else:
+            corpus = list(corpus)
+            self.pprint(corpus, True, domain_spec, json_file)
+            self.print_stats(corpus)
+
+        if checkpoint is not None:
+            checkpoint.remove()
+
+
+class Checkpoint(object):
+    """
+    The committed part of a corpus that is being generated, and what is needed to continue it. It is a folder
+    that contains:
+
+    - domain.pkl: the pickled Domain, so a resumed run uses the same DB
+    - state.json: the corpus seed, the corpus size and the number of committed chunks and dialogs
+    - chunk-<k>.jsonl: the dialogs of chunk k, one per line
+
+    Every file is written to a temporary name first and then renamed, so a run that dies in the middle of a
+    commit leaves the last complete commit behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state_file = os.path.join(path, "state.json")
+        self.domain_file = os.path.join(path, "domain.pkl")
+
+    def chunk_file(self, chunk_id):
+        return os.path.join(self.path, "chunk-%05d.jsonl" % chunk_id)
+
+    def exists(self):
+        return os.path.exists(self.state_file)
+
+    def create(self, domain, seed, size):
+        """
+        Start a new checkpoint with no committed dialogs.
+        """
+        self.remove()
+        os.makedirs(self.path)
+        with open(self.domain_file + ".tmp", "wb") as f:
+            pickle.dump(domain, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(self.domain_file + ".tmp", self.domain_file)
+        self._write_state({'seed': seed, 'size': size, 'num_chunks': 0, 'num_dialogs': 0})
+
+    def load(self, size):
+        """
+        :param size: the expected corpus size
+        :return: the domain, the corpus seed, the number of committed dialogs
+        """
+        state = self._read_state()
+        if state['size'] != size:
+            raise ValueError("Checkpoint %s is for %d dialogs, not %d" % (self.path, state['size'], size))
+        with open(self.domain_file, "rb") as f:
+            domain = pickle.load(f)
+        return domain, state['seed'], state['num_dialogs']
+
+    def commit(self, dialogs):
+        """
+        Append a chunk of dialogs.
+        """
+        state = self._read_state()
+        chunk_file = self.chunk_file(state['num_chunks'])
+        with open(chunk_file + ".tmp", "wb") as f:
+            for d in dialogs:
+                f.write(json.dumps(d, default=Action.json_default) + "\n")
+        os.rename(chunk_file + ".tmp", chunk_file)
+
+        state['num_chunks'] += 1
+        state['num_dialogs'] += len(dialogs)
+        self._write_state(state)
+
+    def iter_dialogs(self):
+        """
+        :return: an iterator over the committed dialogs, in order
+        """
+        for chunk_id in range(self._read_state()['num_chunks']):
+            with open(self.chunk_file(chunk_id), "rb") as f:
+                for line in f:
+                    # keep the key order so the output is byte for byte the same as without a checkpoint
+                    yield json.loads(line, object_pairs_hook=OrderedDict)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def _read_state(self):
+        with open(self.state_file, "rb") as f:
+            return json.load(f)
+
+    def _write_state(self, state):
+        with open(self.state_file + ".tmp", "wb") as f:
+            json.dump(state, f)
+        os.rename(self.state_file + ".tmp", self.state_file)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Generate many corpora in parallel from a job manifest.
+
+A manifest is a JSON file (or the equivalent dict):
+
+    {"language": "en",
+     "output": ".",
+     "seed": 0,
+     "workers": 8,
+     "stream": false,
+     "fields": ["utt", "actions", "state"],
+     "kb_dir": "kb",
+     "domain_cache": "domains",
+     "kbs": {"multiple_domains.BusSpec": "kb/<digest>.npz"},
+     "jobs": [{"domains": ["multiple_domains.RestSpec", "multiple_domains.BusSpec"],
+               "complexities": ["CleanSpec", "MixSpec"],
+               "splits": {"test": 500, "train": 2000}}]}
+
+Each entry of jobs expands into one corpus per domain x complexity x split. Complexity names are looked up in
+simdial.complexity unless they are a full module path. A corpus is written to <output>/<split>/ the same way as
+Generator.gen_corpus, with only the turn fields in fields (all of Generator.FIELDS by default). Every domain
+spec is built into a Domain once and shared by all the corpora that use it.
+The database arrays of the built domains are memory mapped from a temporary folder, so all the workers share
+one copy of them. If kb_dir is given, every newly sampled database is saved there as <digest>.npz. kbs maps a domain spec to a
+database snapshot, given as a path or a digest in kb_dir, or to a SqliteDatabase file, that is used instead of
+sampling a new one. If domain_cache is given, the domains without a kbs entry are compiled into it (see
+Domain.compile), so later runs load them instead of building them again.
+
+Usage: python -m simdial.scheduler manifest.json [--workers N]
+"""
+from simdial.generator import Generator
+from simdial.domain import Domain
+from simdial.database import open_database
+from simdial import complexity
+import multiprocessing
+import numpy as np
+import importlib
+import argparse
+import tempfile
+import logging
+import shutil
+import json
+import os
+
+
+def load_object(path, default_module=None):
+    """
+    :param path: module.name, or just name if default_module is given
+    :return: the object the path refers to
+    """
+    if '.' in path:
+        module_name, obj_name = path.rsplit('.', 1)
+        module = importlib.import_module(module_name)
+    elif default_module is not None:
+        module, obj_name = default_module, path
+    else:
+        raise ValueError("%s is not a full path" % path)
+    return getattr(module, obj_name)
+
+
+class CorpusJob(object):
+    """
+    One corpus in a manifest.
+
+    :ivar domain: the path of the domain spec class
+    :ivar complexity: the path of the complexity spec class
+    :ivar split: the output sub folder, e.g. train or test
+    :ivar size: the number of dialogs
+    :ivar seed: the corpus seed
+    """
+
+    def __init__(self, domain, complexity, split, size, seed):
+        self.domain = domain
+        self.complexity = complexity
+        self.split = split
+        self.size = size
+        self.seed = seed
+
+    def __repr__(self):
+        return "CorpusJob(%s, %s, %s, %d)" % (self.domain, self.complexity, self.split, self.size)
+
+
+class Manifest(object):
+    """
+    A declarative description of a set of corpora. See the module doc for the format.
+
+    :ivar language: the NLG language
+    :ivar output: the root folder of all corpora
+    :ivar seed: the seed that every domain and corpus seed is derived from
+    :ivar workers: the number of processes
+    :ivar stream: write JSON lines instead of one JSON file per corpus
+    :ivar fields: the optional turn fields to output, see Generator
+    :ivar kb_dir: the folder to save database snapshots in, or None
+    :ivar kbs: domain spec path -> database snapshot path or digest, or SqliteDatabase file
+    :ivar domain_cache: the folder of compiled domains, or None
+    :ivar jobs: the list of job groups
+    :cvar DOMAIN: seed key for building domains
+    :cvar JOB: seed key for corpus jobs
+    """
+    DOMAIN = 0
+    JOB = 1
+
+    def __init__(self, manifest):
+        """
+        :param manifest: a dict in the manifest format
+        """
+        self.language = manifest.get('language', 'cn')
+        self.output = manifest.get('output', '.')
+        self.seed = manifest.get('seed', 0)
+        self.workers = manifest.get('workers', multiprocessing.cpu_count())
+        self.stream = manifest.get('stream', False)
+        self.fields = manifest.get('fields', Generator.FIELDS)
+        self.kb_dir = manifest.get('kb_dir')
+        self.kbs = manifest.get('kbs', {})
+        self.domain_cache = manifest.get('domain_cache')
+        self.jobs = manifest['jobs']
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(json.load(f))
+
+    def domains(self):
+        """
+        :return: the distinct domain spec paths, in the order they first appear
+        """
+        domains = []
+        for group in self.jobs:
+            for d in group['domains']:
+                if d not in domains:
+                    domains.append(d)
+        return domains
+
+    def expand(self):
+        """
+        :return: a list of CorpusJob, one for each domain x complexity x split of every job group
+        """
+        corpus_jobs = []
+        for group in self.jobs:
+            for d in group['domains']:
+                for c in group['complexities']:
+                    for split in sorted(group['splits'].keys()):
+                        corpus_jobs.append(CorpusJob(d, c, split, group['splits'][split],
+                                                     self.derive_seed(self.JOB, len(corpus_jobs))))
+        return corpus_jobs
+
+    def derive_seed(self, *keys):
+        """
+        :return: a seed derived from the manifest seed and the integer keys
+        """
+        return np.random.RandomState([self.seed] + list(keys)).randint(0, 2**31-1)
+
+
+# per process state of the worker pools in Scheduler
+_worker = {}
+
+
+def _build_domain(args):
+    domain_path, seed, kb, kb_dir, domain_cache, share_dir = args
+    if kb is None and domain_cache is not None:
+        # the database of a compiled domain is already shared
+        domain = Domain.compile(load_object(domain_path)(), domain_cache, seed=seed)
+    else:
+        db = None if kb is None else open_database(kb, kb_dir=kb_dir)
+        domain = Domain(load_object(domain_path)(), seed=seed, db=db)
+        # only the file names of a shared database are sent back to the parent
+        os.makedirs(share_dir)
+        domain.db.share(share_dir)
+    if kb_dir is not None and kb is None:
+        Scheduler.logger.info("Saved the database of %s to %s" % (domain_path, domain.db.save(kb_dir)))
+    return domain_path, domain
+
+
+def _init_worker(scheduler, domains):
+    _worker['args'] = (scheduler, domains)
+
+
+def _run_job(job):
+    scheduler, domains = _worker['args']
+    scheduler.run_job(job, domains[job.domain])
+    return job
+
+
+class Scheduler(object):
+    """
+    Run the job graph of a manifest: first build every distinct Domain, then generate all the corpora that depend
+    on them. Both stages run concurrently in a process pool.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, manifest):
+        """
+        :param manifest: a Manifest
+        """
+        self.manifest = manifest
+
+    def build_domains(self, pool, share_dir):
+        """
+        :param share_dir: the folder to keep the shared database arrays in
+        :return: domain spec path -> Domain
+        """
+        domain_paths = self.manifest.domains()
+        args = [(path, self.manifest.derive_seed(Manifest.DOMAIN, idx), self.manifest.kbs.get(path),
+                 self.manifest.kb_dir, self.manifest.domain_cache, os.path.join(share_dir, str(idx)))
+                for idx, path in enumerate(domain_paths)]
+        return dict(pool.map(_build_domain, args))
+
+    def run_job(self, job, domain):
+        generator = Generator(self.manifest.language, fields=self.manifest.fields)
+        generator.gen_corpus(os.path.join(self.manifest.output, job.split), load_object(job.domain)(),
+                             load_object(job.complexity, complexity), job.size, seed=job.seed,
+                             stream=self.manifest.stream, domain=domain)
+
+    def run(self):
+        """
+        Generate every corpus in the manifest.
+
+        :return: the list of finished CorpusJob
+        """
+        corpus_jobs = self.manifest.expand()
+        for split in set(job.split for job in corpus_jobs):
+            path = os.path.join(self.manifest.output, split)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        for path in [self.manifest.kb_dir, self.manifest.domain_cache]:
+            if path is not None and not os.path.exists(path):
+                os.makedirs(path)
+
+        share_dir = tempfile.mkdtemp(prefix="simdial-")
+        try:
+            pool = multiprocessing.Pool(self.manifest.workers)
+            try:
+                domains = self.build_domains(pool, share_dir)
+            finally:
+                pool.terminate()
+                pool.join()
+
+            # the workers of the second pool inherit the built domains instead of receiving a copy per job
+            finished = []
+            pool = multiprocessing.Pool(self.manifest.workers, initializer=_init_worker, initargs=(self, domains))
+            try:
+                for job in pool.imap_unordered(_run_job, corpus_jobs):
+                    self.logger.info("Finished %s" % job)
+                    finished.append(job)
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            shutil.rmtree(share_dir)
+        return finished
+
+
+def run_manifest(manifest, workers=None):
+    """
+    :param manifest: a manifest dict, or the path to a manifest JSON file
+    :param workers: overrides the number of processes in the manifest
+    :return: the list of finished CorpusJob
+    """
+    manifest = Manifest(manifest) if isinstance(manifest, dict) else Manifest.load(manifest)
+    if workers is not None:
+        manifest.workers = workers
+    return Scheduler(manifest).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the corpora in a job manifest.")
+    parser.add_argument('manifest', help="path to the manifest JSON file")
+    parser.add_argument('--workers', type=int, default=None, help="override the number of processes")
+    args = parser.parse_args()
+    run_manifest(args.manifest, args.workers)
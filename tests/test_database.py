@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the query paths of Database and SqliteDatabase.
+"""
+from simdial.database import Database, SqliteDatabase
+import numpy as np
+import threading
+import pickle
+import tempfile
+import unittest
+import shutil
+import os
+
+
+class SqliteDatabaseThreadTest(unittest.TestCase):
+    NUM_THREADS = 8
+    NUM_QUERIES = 300
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.memory_db = Database([np.ones(8)] * 3, [np.ones(4)] * 2, 5000, rng=np.random.RandomState(0))
+        self.path = os.path.join(self.tmp_dir, "db" + SqliteDatabase.EXTENSION)
+        SqliteDatabase.from_database(self.memory_db, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shared_cache(self):
+        # a cache of 3 bitsets, so the threads evict each other's entries all the time
+        num_bytes = len(self.memory_db.all_rows)
+        db = SqliteDatabase(self.path, cache_bytes=3 * num_bytes)
+        errors = []
+
+        def run(seed):
+            rng = np.random.RandomState(seed)
+            try:
+                for _ in range(self.NUM_QUERIES):
+                    query = rng.randint(0, 8, size=3).tolist()
+                    self.assertEqual(db.count(query), self.memory_db.count(query))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(seed,)) for seed in range(self.NUM_THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        db.close()
+
+        self.assertEqual(errors, [])
+        cache = db.query_cache
+        self.assertEqual(cache.nbytes, sum(v.nbytes for v in cache.entries.values()))
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+
+class DatabaseMmapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_close_removes_folder(self):
+        db = Database([np.ones(8)] * 3, [np.ones(4)] * 2, 1000, rng=np.random.RandomState(0), mmap_dir=self.tmp_dir)
+        self.assertEqual(os.listdir(self.tmp_dir), [os.path.basename(db.mmap_dir)])
+        count = db.count([1, 2, 0])
+        # a copy holds the tables themselves and never removes the folder
+        copy = pickle.loads(pickle.dumps(db))
+        self.assertIsNone(copy.mmap_dir)
+        self.assertEqual(copy.count([1, 2, 0]), count)
+
+        db.close()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+        self.assertIsNone(db.mmap_dir)
+        self.assertEqual(db.count([1, 2, 3]), copy.count([1, 2, 3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
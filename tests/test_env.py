@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the action masks of the dialog environments.
+"""
+from simdial.domain import Domain
+from simdial.complexity import Complexity, MixSpec
+from simdial.env import DialogEnv, VecDialogEnv
+from simdial.agent.policy import DiscreteActions
+from multiple_domains import RestSpec
+import numpy as np
+import unittest
+
+
+class ActionMaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.domain = Domain(RestSpec, seed=0)
+        self.complexity = Complexity(MixSpec)
+
+    def test_random_codes(self):
+        # every valid code steps without an error, and every other code raises ValueError and changes nothing
+        rng = np.random.RandomState(0)
+        env = DialogEnv(self.domain, self.complexity, seed=1, fields=('utt', 'actions'))
+        obs = env.reset()
+        for _ in range(1000):
+            mask = obs['action_mask']
+            invalid = np.flatnonzero(~mask)
+            if len(invalid):
+                num_turns = len(env.state.history)
+                self.assertRaises(ValueError, env.step, rng.choice(invalid))
+                self.assertEqual(len(env.state.history), num_turns)
+            valid = np.flatnonzero(mask)
+            if len(valid) > 1:
+                valid = valid[valid != DiscreteActions.GOODBYE]
+            obs, reward, done, info = env.step(rng.choice(valid))
+            if done:
+                obs = env.reset()
+
+    def test_vec_step_is_atomic(self):
+        env = VecDialogEnv(self.domain, self.complexity, 4, seed=1)
+        obs = env.reset()
+        # there is no KB return to inform in the first turn, so the step of every environment is refused
+        codes = [DiscreteActions.GREET] * 4
+        codes[2] = DiscreteActions.INFORM
+        self.assertFalse(obs['action_mask'][2, DiscreteActions.INFORM])
+        self.assertRaises(ValueError, env.step, codes)
+        self.assertTrue(all(len(e.state.history) == 0 for e in env.envs))
+        env.step([DiscreteActions.GREET] * 4)
+        self.assertTrue(all(len(e.state.history) == 2 for e in env.envs))
+
+
+class SlotIdTest(unittest.TestCase):
+
+    def test_slot_codes(self):
+        domain = Domain(RestSpec, seed=0)
+        env = DialogEnv(domain, Complexity(MixSpec), seed=1)
+        obs = env.reset()
+        actions = env.actions
+        for i, sid in enumerate(obs['slot_ids']):
+            self.assertEqual(domain.get_slot(sid).name, actions.table.slot_names[i])
+            for act in DiscreteActions.SLOT_ACTS:
+                self.assertEqual(actions.slot_act(actions.slot_code(act, sid)), (act, sid))
+        self.assertEqual([domain.get_slot(sid).name for sid in obs['goal_ids']], list(env.state.sys_goals))
+        self.assertIsNone(actions.slot_act(DiscreteActions.QUERY))
+
+        # a slot request asks for the slot of its id
+        sid = obs['slot_ids'][0]
+        decision = actions.decode(actions.slot_code(DiscreteActions.SLOT_ACTS[0], sid), env.state)
+        self.assertEqual(decision[0].parameters[0][0], domain.get_slot(sid).name)
+
+
+if __name__ == '__main__':
+    unittest.main()